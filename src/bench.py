@@ -0,0 +1,125 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import argparse
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+import detect
+import metadata
+import util
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), "corpus")
+
+
+def corpus_path(discid):
+    return os.path.join(CORPUS_DIR, f"{discid}{metadata.CORPUS_EXT}")
+
+
+def record(discids):
+    os.makedirs(CORPUS_DIR, exist_ok=True)
+    spec = util.SETTINGS.value("fripper/metadata")
+    for discid in discids:
+        provider = metadata.RecordingProvider(metadata.create_provider(spec))
+        try:
+            releases = detect.get_releases(discid, provider)
+        except Exception as e:
+            print(f"{discid}: {e}")
+            continue
+        provider.save(corpus_path(discid))
+        count = len(provider.responses)
+        print(f"{discid}: {len(releases)} releases, {count} responses")
+
+
+def run(discid, latency, repeat, parallel=None):
+    """
+    Returns the (release count, request count, detection times, peak memory) of
+    looking up the disc through the recorded responses, with parallel requests
+    if "parallel" is set (by default, as the recorded source allowed).
+    """
+    provider = metadata.ReplayProvider(corpus_path(discid), latency, parallel)
+
+    times = []
+    for _ in range(repeat):
+        provider.requests = 0
+        start = time.perf_counter()
+        releases = detect.get_releases(discid, provider)
+        times.append(time.perf_counter() - start)
+    requests = provider.requests
+
+    # Measured in a separate run, since tracing allocations slows things down.
+    tracemalloc.start()
+    try:
+        detect.get_releases(discid, provider)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return len(releases), requests, times, peak
+
+
+def main(argv):
+    # Usage: bench.py record [discid ...]
+    #        bench.py [--latency MS] [--repeat N] [discid ...]
+    #
+    # "record" saves the responses of the configured metadata source to the
+    # corpus; the samples in detect.SAMPLE_DISCS are used if no discs are given.
+    if argv and argv[0] == "record":
+        record(argv[1:] or list(detect.SAMPLE_DISCS))
+        return 0
+
+    parser = argparse.ArgumentParser(description="benchmark metadata detection")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=50,
+        metavar="MS",
+        help="simulated latency of each request (default: 50)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        metavar="N",
+        help="number of timed runs per disc (default: 3)",
+    )
+    parser.add_argument("discids", nargs="*", help="discs to look up")
+    args = parser.parse_args(argv)
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    # Each disc is looked up both like the default, rate-limited MusicBrainz
+    # source (one request at a time) and like sources allowing parallel requests.
+    print(
+        f"{'discid':30} {'mode':8} {'rels':>4} {'reqs':>4} {'median ms':>9} "
+        f"{'min ms':>7} {'peak KiB':>8}"
+    )
+    failed = 0
+    for discid in args.discids or detect.SAMPLE_DISCS:
+        if not os.path.exists(corpus_path(discid)):
+            print(f"{discid:30} not recorded; run 'bench.py record {discid}'")
+            failed += 1
+            continue
+
+        for mode, parallel in (("serial", False), ("parallel", True)):
+            try:
+                latency = args.latency / 1000
+                rels, reqs, times, peak = run(discid, latency, args.repeat, parallel)
+            except Exception as e:
+                print(f"{discid:30} {mode:8} failed: {e}")
+                failed += 1
+                continue
+
+            median = statistics.median(times) * 1000
+            best = min(times) * 1000
+            print(
+                f"{discid:30} {mode:8} {rels:>4} {reqs:>4} {median:>9.1f} "
+                f"{best:>7.1f} {peak / 1024:>8.0f}"
+            )
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
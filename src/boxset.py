@@ -0,0 +1,208 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import json
+import os
+import threading
+
+import detect
+import util
+
+SESSION_DIR = "sessions"
+
+# Releases fetched during detection, by release ID. Only the one the user picks
+# ends up in a session.
+_releases = {}
+_sessions = {}
+_lock = threading.Lock()
+
+
+class Session:
+    """
+    Box-set session: keeps the resolved release, cover art and user edits for a
+    multi-disc release, so that the remaining discs can be detected locally and
+    don't need to be edited again.
+    """
+
+    def __init__(self, release, cover_art=None, edits=None, ripped=None):
+        self.release = release
+        self.cover_art = cover_art
+        self.edits = edits or {}
+        self.ripped = set(ripped or [])
+
+    @property
+    def release_id(self):
+        return self.release["id"]
+
+    def discids(self):
+        return {
+            d["id"] for m in self.release["medium-list"] for d in m.get("disc-list", [])
+        }
+
+    def record_edits(self, original, edited):
+        """
+        Records the changes made by the user to a disc's info. Album-level edits
+        are kept as (original, new) pairs so they only apply to discs where the
+        original value matches; track titles are kept per disc.
+
+        Discs after the first are detected with the earlier edits applied, so new
+        edits are chained to the value from the release: they keep applying to
+        the remaining discs.
+        """
+        for field in ("artist", "album", "year"):
+            old = getattr(original, field)
+            new = getattr(edited, field)
+            if field in self.edits and self.edits[field][1] == old:
+                old = self.edits[field][0]
+            if old != new:
+                self.edits[field] = [old, new]
+            elif field in self.edits and self.edits[field][0] == old:
+                del self.edits[field]
+
+        artists = self.edits.setdefault("artists", {})
+        titles = {}
+        for old, new in zip(original.tracks, edited.tracks):
+            if old.artist != new.artist:
+                for k, v in artists.items():
+                    if v == old.artist:
+                        artists[k] = new.artist
+                artists[old.artist] = new.artist
+            if old.title != new.title:
+                titles[str(new.trackno)] = new.title
+        self.edits.setdefault("titles", {})[str(edited.discno)] = titles
+
+        if edited.cover_art:
+            self.cover_art = edited.cover_art
+
+    def disc_info(self, discid):
+        """
+        Returns the CDInfo for the given disc of the set, with the user's edits
+        applied.
+        """
+        discno, album = detect.find_disc(self.release, discid)
+        disc = detect.cd_info_from_release(
+            self.release, discid, discno, album, self.cover_art
+        )
+
+        for field in ("artist", "album", "year"):
+            if field in self.edits:
+                old, new = self.edits[field]
+                if getattr(disc, field) == old:
+                    setattr(disc, field, new)
+
+        artists = self.edits.get("artists", {})
+        titles = self.edits.get("titles", {}).get(str(discno), {})
+        for t in disc.tracks:
+            t.artist = artists.get(t.artist, t.artist)
+            t.title = titles.get(str(t.trackno), t.title)
+            if "album" in self.edits and t.album == self.edits["album"][0]:
+                t.album = self.edits["album"][1]
+
+        return disc
+
+    @property
+    def complete(self):
+        return len(self.ripped) >= self.release["medium-count"]
+
+    def save(self):
+        base = _session_path(self.release_id)
+        data = {
+            "release": self.release,
+            "edits": self.edits,
+            "ripped": sorted(self.ripped),
+        }
+        with open(f"{base}.json", "w", encoding="utf-8") as f:
+            json.dump(data, f)
+
+        if self.cover_art:
+            with open(f"{base}.jpg", "wb") as f:
+                f.write(self.cover_art)
+
+    def delete(self):
+        base = _session_path(self.release_id)
+        for ext in ("json", "jpg"):
+            if os.path.exists(f"{base}.{ext}"):
+                os.unlink(f"{base}.{ext}")
+
+    @staticmethod
+    def load(path):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+
+        cover_art = None
+        art = path[: -len(".json")] + ".jpg"
+        if os.path.exists(art):
+            with open(art, "rb") as f:
+                cover_art = f.read()
+
+        return Session(data["release"], cover_art, data["edits"], data["ripped"])
+
+
+def _session_path(release_id):
+    path = util.data_path(SESSION_DIR)
+    os.makedirs(path, exist_ok=True)
+    return os.path.join(path, release_id)
+
+
+def _load_sessions():
+    path = util.data_path(SESSION_DIR)
+    if not os.path.isdir(path):
+        return
+
+    for name in os.listdir(path):
+        relid, ext = os.path.splitext(name)
+        if ext != ".json" or relid in _sessions:
+            continue
+        try:
+            _sessions[relid] = Session.load(os.path.join(path, name))
+        except Exception:
+            util.print_error()
+
+
+def remember_release(rel):
+    with _lock:
+        _releases[rel["id"]] = rel
+
+
+def lookup(discid):
+    """
+    Returns the discs from known box-set sessions matching the disc ID, or an
+    empty list.
+    """
+    with _lock:
+        _load_sessions()
+        sessions = [s for s in _sessions.values() if discid in s.discids()]
+
+    ret = []
+    for s in sessions:
+        try:
+            ret.append(s.disc_info(discid))
+        except Exception:
+            util.print_error()
+    return ret
+
+
+def update(original, edited):
+    """
+    Updates (or starts) the session for a multi-disc release after the user has
+    confirmed the disc's info, and marks the disc as ripped. Sessions are removed
+    once all discs of the set have been ripped.
+    """
+    if edited.set_size <= 1 or not edited.release_id:
+        return
+
+    with _lock:
+        _load_sessions()
+        session = _sessions.get(edited.release_id)
+        if not session:
+            rel = _releases.get(edited.release_id)
+            if not rel:
+                return
+            session = Session(rel)
+            _sessions[edited.release_id] = session
+
+        session.record_edits(original, edited)
+        session.ripped.add(edited.discno)
+        if session.complete:
+            session.delete()
+            del _sessions[edited.release_id]
+        else:
+            session.save()
@@ -1,11 +1,16 @@
 # SPDX-License-Identifier: BSD-2-Clause
+import copy
 import os
 
+import metadata
+import naming
+import pipeline
 import util
 from PyQt5.QtCore import QBuffer
 from PyQt5.QtCore import QByteArray
 from PyQt5.QtCore import QIODevice
 from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage
 from PyQt5.QtGui import QPixmap
 from PyQt5.QtWidgets import QFileDialog
 from PyQt5.QtWidgets import QLabel
@@ -15,6 +20,15 @@ from PyQt5.QtWidgets import QPushButton
 from PyQt5.QtWidgets import QVBoxLayout
 from PyQt5.QtWidgets import QWidget
 
+# Cover art policies, in the order they're shown in the UI.
+COVER_ART_EMBED = "embed"
+COVER_ART_THUMBNAIL = "thumbnail"
+COVER_ART_SIDECAR = "sidecar"
+COVER_ART_POLICIES = [COVER_ART_EMBED, COVER_ART_THUMBNAIL, COVER_ART_SIDECAR]
+
+# Replacements for characters that are unsafe in file names.
+FS_SAFE = str.maketrans("/*$^&%|[{}]\n\t:;'?!\"´", "--____-(())--__---.'")
+
 
 def cmd_fmt_variables(
     track,
@@ -47,10 +61,8 @@ def dest_fmt_variables(disc, track, ext):
     if len(disc.tracks) >= 10:
         trackno = f"{track.trackno:02}"
 
-    tbl = str.maketrans("/*$^&%|[{}]\n\t:;'?!\"´", "--____-(())--__---.'")
-
     def fs_safe(s):
-        return s.translate(tbl)
+        return s.translate(FS_SAFE)
 
     return {
         "artist": fs_safe(disc.artist),
@@ -62,6 +74,41 @@ def dest_fmt_variables(disc, track, ext):
     }
 
 
+def multi_disc_album(disc):
+    """
+    Returns the album name used when ripping a disc of a set as its own album.
+    """
+    return f"{disc.album} (Disc {disc.discno})"
+
+
+def scale_image(data, max_size):
+    """
+    Scales down image data so that it fits in a max_size x max_size box, returning
+    JPEG data. Returns the original data if it's already small enough.
+    """
+    image = QImage()
+    image.loadFromData(data)
+    size = image.size()
+    if size.width() <= max_size and size.height() <= max_size:
+        return data
+
+    image = image.scaled(
+        max_size, max_size, Qt.KeepAspectRatio, Qt.SmoothTransformation
+    )
+
+    bytes = QByteArray()
+    buf = QBuffer(bytes)
+    buf.open(QIODevice.WriteOnly)
+    image.save(buf, "JPG")
+    return bytes.data()
+
+
+def image_mime(data):
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    return "image/jpeg"
+
+
 class CoverLabel(QLabel):
     def __init__(self, parent, cover):
         super().__init__(parent)
@@ -84,7 +131,11 @@ class CoverLabel(QLabel):
             return
 
         try:
-            self.cover_data = util.http_get(url.toString())
+            try:
+                self.cover_data = metadata.provider().get_image(url.toString())
+            except Exception:
+                # E.g. a replayed corpus only serves the covers it recorded.
+                self.cover_data = util.http_get(url.toString())
             self._set_cover()
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Error downloading {url}: {e}.")
@@ -93,23 +144,12 @@ class CoverLabel(QLabel):
         if not self.cover_data:
             return
 
+        self.cover_data = scale_image(self.cover_data, 1000)
+
         cover = QPixmap()
         cover.loadFromData(self.cover_data)
         size = cover.size()
 
-        max_size = 1000
-        if size.width() > max_size or size.height() > max_size:
-            cover = cover.scaled(
-                max_size, max_size, Qt.KeepAspectRatio, Qt.SmoothTransformation
-            )
-            size = cover.size()
-
-            bytes = QByteArray()
-            buf = QBuffer(bytes)
-            buf.open(QIODevice.WriteOnly)
-            cover.save(buf, "JPG")
-            self.cover_data = bytes.data()
-
         self.cover = cover
         self.setToolTip(f"{size.width()} x {size.height()}")
         self._scale_cover()
@@ -133,12 +173,14 @@ class CoverLabel(QLabel):
 
 
 class InfoDialog(util.compile_ui("cdinfo.ui")):
-    def __init__(self, disc, config):
+    def __init__(self, disc, config, existing=()):
         super().__init__()
         self.setWindowModality(Qt.ApplicationModal)
 
         self.disc = disc
         self.config = config
+        # Files of the disc already in the library, which may be overwritten.
+        self.existing = existing
 
         vbox = QVBoxLayout()
         self.fCover.setLayout(vbox)
@@ -167,6 +209,18 @@ class InfoDialog(util.compile_ui("cdinfo.ui")):
         self.leTarget.setText(config.target)
         self.leEncoder.setText(config.encoder)
         self.leTemplate.setText(config.template)
+        # Unknown (e.g. stale) settings fall back to the default policy.
+        cover_art = config.cover_art
+        if cover_art not in COVER_ART_POLICIES:
+            cover_art = COVER_ART_EMBED
+        self.cbCoverArt.setCurrentIndex(COVER_ART_POLICIES.index(cover_art))
+        self.sbThumbSize.setValue(config.thumb_size)
+        self.cbWholeDisc.setChecked(config.whole_disc)
+        self.cbWholeDisc.setEnabled(bool(disc.toc))
+        self.cbNativeReader.setChecked(config.native_reader)
+        self.cbNativeReader.setEnabled(bool(disc.toc))
+        self.cbAutoSpeed.setChecked(config.auto_speed)
+        self.cbVerify.setChecked(config.verify)
 
         increment = 1
         self.artists = None
@@ -232,13 +286,6 @@ class InfoDialog(util.compile_ui("cdinfo.ui")):
             return
 
         d.discno = int(self.leDisc.text())
-        dest_vars = dest_fmt_variables(d, d.tracks[0], "ext")
-        try:
-            self.leTemplate.text().format(**dest_vars)
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"Invalid file name template: {e}")
-            return
-
         d.artist = self.leArtist.text()
         d.album = self.leAlbum.text()
         d.year = int(self.leYear.text())
@@ -251,9 +298,35 @@ class InfoDialog(util.compile_ui("cdinfo.ui")):
         for i in range(len(d.tracks)):
             d.tracks[i].title = self.trackNames[i].text()
 
+        # Expand the template for all tracks now, so that problems with the file
+        # names show up before ripping instead of when committing the files.
+        planned = d
+        if self.rip_as_multi_disc:
+            planned = copy.deepcopy(d)
+            planned.album = multi_disc_album(d)
+        try:
+            template = naming.compile_template(self.leTemplate.text())
+            # Retagging doesn't write the rip's stats or a cue sheet.
+            extras = []
+            if not self.existing:
+                extras.append(naming.stats_name(planned))
+            if self.cbWholeDisc.isChecked() and d.toc and not self.existing:
+                extras.append(naming.cue_name(planned))
+            target = self.leTarget.text()
+            template.plan(planned, pipeline.EXT, target, self.existing, extras)
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Invalid file names:\n{e}")
+            return
+
         self.config.target = self.leTarget.text()
         self.config.encoder = self.leEncoder.text()
         self.config.template = self.leTemplate.text()
+        self.config.cover_art = COVER_ART_POLICIES[self.cbCoverArt.currentIndex()]
+        self.config.thumb_size = self.sbThumbSize.value()
+        self.config.whole_disc = self.cbWholeDisc.isChecked()
+        self.config.native_reader = self.cbNativeReader.isChecked()
+        self.config.auto_speed = self.cbAutoSpeed.isChecked()
+        self.config.verify = self.cbVerify.isChecked()
         self.accept()
 
     def _get_target(self):
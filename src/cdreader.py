@@ -0,0 +1,165 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import time
+
+import cdio
+import pycdio
+
+SECTOR_SIZE = 2352
+
+# LBA of the first sector addressable by LSN 0 (the 2 second lead-in).
+LBA_OFFSET = 150
+
+# Sectors per read request. On errors the batch size is halved down to a single
+# sector, and doubled again after clean reads.
+BATCH_SECTORS = 75 * 4
+MAX_RETRIES = 20
+
+
+class DeviceSource:
+    """
+    Reads audio sectors from a CD drive through libcdio.
+    """
+
+    def __init__(self, device=None):
+        if device:
+            self.device = cdio.Device(device)
+        else:
+            self.device = cdio.Device(driver_id=pycdio.DRIVER_UNKNOWN)
+
+    def set_speed(self, speed):
+        # libcdio uses -1 for the drive's maximum.
+        try:
+            self.device.set_speed(speed or -1)
+        except cdio.DeviceException:
+            pass
+
+    def read_into(self, lsn, view):
+        count = len(view) // SECTOR_SIZE
+        try:
+            size, data = self.device.read_sectors(lsn, pycdio.READ_MODE_AUDIO, count)
+        except cdio.DeviceException as e:
+            raise IOError(f"read error at sector {lsn}: {e}")
+        if size != len(view):
+            raise IOError(f"short read at sector {lsn}: {size} bytes")
+        view[:] = data
+
+    def close(self):
+        self.device.close()
+
+
+class ImageSource:
+    """
+    Fake device backed by a raw CD-DA image (or silence, when no path is given).
+    Sectors in "bad" fail the given number of times before reading correctly, or
+    forever if the count is negative.
+    """
+
+    def __init__(self, path=None, bad=None):
+        self.file = open(path, "rb") if path else None
+        self.bad = dict(bad or {})
+        self.reads = 0
+        self.speed = None
+
+    def set_speed(self, speed):
+        self.speed = speed
+
+    def read_into(self, lsn, view):
+        self.reads += 1
+        count = len(view) // SECTOR_SIZE
+        for s in range(lsn, lsn + count):
+            fails = self.bad.get(s, 0)
+            if fails:
+                self.bad[s] = fails - 1
+                raise IOError(f"read error at sector {s}")
+
+        if not self.file:
+            view[:] = bytes(len(view))
+            return
+
+        self.file.seek(lsn * SECTOR_SIZE)
+        if self.file.readinto(view) != len(view):
+            raise IOError(f"short read at sector {lsn}")
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+class ReadStats:
+    def __init__(self):
+        self.sectors = 0
+        self.retries = 0
+        self.bad_sectors = []
+        self.elapsed = 0.0
+
+    @property
+    def speed(self):
+        """
+        Effective read speed, as a multiple of real time.
+        """
+        if not self.elapsed:
+            return 0.0
+        return self.sectors / 75 / self.elapsed
+
+
+class NativeReader:
+    """
+    Reads audio through a sector source in large batches into a reusable buffer.
+    Only batches that fail are re-read, sector by sector, with retries.
+    """
+
+    def __init__(self, source, batch=BATCH_SECTORS, retries=MAX_RETRIES):
+        self.source = source
+        self.max_batch = batch
+        self.batch = batch
+        self.retries = retries
+        self.buffer = bytearray(batch * SECTOR_SIZE)
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def read(self, lba, sectors, write):
+        """
+        Reads "sectors" sectors starting at the given LBA, passing the data to
+        "write" in order. Raises an exception if a sector can't be read after all
+        retries.
+        """
+        stats = ReadStats()
+        start = time.monotonic()
+        view = memoryview(self.buffer)
+        lsn = lba - LBA_OFFSET
+        end = lsn + sectors
+
+        while lsn < end:
+            if self.cancelled:
+                raise Exception("read cancelled")
+
+            count = min(self.batch, end - lsn)
+            chunk = view[: count * SECTOR_SIZE]
+            try:
+                self.source.read_into(lsn, chunk)
+                self.batch = min(self.batch * 2, self.max_batch)
+            except IOError:
+                self._reread(lsn, chunk, stats)
+                self.batch = max(self.batch // 2, 1)
+
+            write(chunk)
+            lsn += count
+            stats.sectors += count
+
+        stats.elapsed = time.monotonic() - start
+        return stats
+
+    def _reread(self, lsn, chunk, stats):
+        for i in range(len(chunk) // SECTOR_SIZE):
+            sector = chunk[i * SECTOR_SIZE : (i + 1) * SECTOR_SIZE]
+            for attempt in range(self.retries + 1):
+                try:
+                    self.source.read_into(lsn + i, sector)
+                    break
+                except IOError:
+                    stats.retries += 1
+            else:
+                stats.bad_sectors.append(lsn + i + LBA_OFFSET)
+                raise Exception(f"unrecoverable read error at sector {lsn + i}")
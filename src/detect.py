@@ -2,11 +2,15 @@
 import base64
 import datetime
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 
+import boxset
 import cdio
-import musicbrainzngs as mb
+import metadata
 import pycdio
+import tocdb
+import tracing
 import util
 from PyQt5.QtCore import QThread
 from PyQt5.QtCore import pyqtSignal
@@ -14,13 +18,36 @@ from PyQt5.QtWidgets import QDialog
 from PyQt5.QtWidgets import QHBoxLayout
 from PyQt5.QtWidgets import QLabel
 
-mb.set_useragent("fripper", "1.0")
+# Some interesting disc IDs, used by the benchmark in bench.py.
+SAMPLE_DISCS = {
+    "dCZWjhrnNC_JSgv9lqSZQ_SPc3c-": "normal album (Haken - Vector)",
+    "x0uC3CqZCMC8_Qr2OsgL59MkmYE-": "double album, disc 2 (Satriani - Live in SF)",
+    "kLu3X6F6GwZwCwvdhCVQs4R9iPc-": "disc 2 with data track (The Ocean - Precambrian)",
+    "SCP4nE6BDCTkQnHMzs6LiBuHCdg-": "multiple artists (Merry Axemas)",
+    "VsCC5lu9uDTPZO5uUG6BiQ_OziI-": "reissue + bonus tracks (King Diamond - Abigail)",
+    "5vdHnGO7X5GvTQvzRhwMhGxW6_0-": "lots of releases (Kate Bush - Hounds of Love)",
+    "RBiq_Z3vfD7L_dPbTCeeM3BL5mU-": '"remasters" collection (Judas Priest - Turbo)',
+}
 
 
 @dataclass
 class DiscInfo:
     discid: str
     track_count: int
+    first: int = 1
+    offsets: list = None
+    leadout: int = 0
+
+    @property
+    def toc(self):
+        """
+        Returns the TOC in the format used by musicbrainz: first track, last track,
+        leadout, followed by the LBA offsets of each audio track.
+        """
+        if not self.offsets:
+            return ""
+        last = self.first + len(self.offsets) - 1
+        return " ".join(str(x) for x in [self.first, last, self.leadout] + self.offsets)
 
 
 @dataclass
@@ -29,6 +56,8 @@ class TrackInfo:
     album: str
     title: str
     trackno: int
+    recording_id: str = ""
+    track_id: str = ""
 
 
 @dataclass
@@ -42,6 +71,9 @@ class CDInfo:
     multi_artist: bool
     cover_art: list
     disambiguation: str = ""
+    discid: str = ""
+    release_id: str = ""
+    toc: str = ""
 
 
 class DetectorTask(QThread):
@@ -52,21 +84,40 @@ class DetectorTask(QThread):
         self.releases = None
 
     def run(self):
+        tracing.name_thread("detector")
+        with tracing.stage("detect"):
+            self._detect()
+
+    def _detect(self):
         tracks = None
+        toc = ""
         if not self.discid:
             try:
                 info = get_disc_info()
                 self.discid = info.discid
                 tracks = info.track_count
+                toc = info.toc
             except Exception as e:
                 util.show_error(e, message="Error reading disc information")
                 return
 
+        self.releases = boxset.lookup(self.discid)
+        if self.releases:
+            for r in self.releases:
+                r.toc = toc
+            return
+
         self.dlg.message.emit("Getting data from musicbrainz...")
 
         try:
             self.releases = get_releases(self.discid)
         except Exception:
+            self.releases = self._local_lookup(toc)
+            if self.releases:
+                for r in self.releases:
+                    r.discid = self.discid
+                return
+
             util.show_error("Could not find CD info in musicbrainz")
             if not tracks:
                 # Happens during testing only. Just set a bogus number
@@ -83,6 +134,7 @@ class DetectorTask(QThread):
                     multi_artist=False,
                     set_size=1,
                     cover_art=None,
+                    discid=self.discid,
                     tracks=[
                         TrackInfo(
                             artist="Unknown",
@@ -95,6 +147,24 @@ class DetectorTask(QThread):
                 ),
             ]
 
+        for r in self.releases:
+            r.toc = toc
+
+    def _local_lookup(self, toc):
+        if not toc:
+            return None
+
+        self.dlg.message.emit("Searching local disc database...")
+        try:
+            db = tocdb.TocDB()
+            try:
+                return db.lookup(toc)
+            finally:
+                db.close()
+        except Exception:
+            util.print_error()
+            return None
+
 
 class DetectionDialog(QDialog):
     message = pyqtSignal(str)
@@ -233,37 +303,79 @@ def get_disc_info():
     return DiscInfo(
         discid=b64.translate(tbl),
         track_count=count,
+        first=first,
+        offsets=[tracks[i] for i in sorted(tracks) if i],
+        leadout=leadout,
     )
 
 
-def get_releases(discid):
-    ret = mb.get_releases_by_discid(discid)
+def get_releases(discid, provider=None):
+    provider = provider or metadata.provider()
+    ret = provider.get_releases_by_discid(discid)
     releases = ret.get("disc", {}).get("release-list")
     if not releases:
         raise Exception(f"no release found for {discid}")
-    return [get_cd_info(r, discid) for r in releases]
 
+    if provider.parallel and len(releases) > 1:
+        with ThreadPoolExecutor(max_workers=len(releases)) as pool:
+            return list(pool.map(lambda r: get_cd_info(r, discid, provider), releases))
 
-def get_cd_info(rel, discid):
-    discno = None
+    return [get_cd_info(r, discid, provider) for r in releases]
+
+
+def find_disc(rel, discid):
+    """
+    Returns the (disc number, album title) of the medium with the given disc ID.
+    """
     album = rel.get("title")
     for medium in rel["medium-list"]:
-        for disc in medium["disc-list"]:
+        for disc in medium.get("disc-list", []):
             if disc["id"] == discid:
-                discno = int(medium["position"])
-                album = medium.get("title", album)
-                break
-        if discno:
-            break
-    else:
-        raise Exception("could not find disc no")
+                return int(medium["position"]), medium.get("title", album)
+
+    raise Exception("could not find disc no")
+
+
+def get_cd_info(rel, discid, provider=None):
+    provider = provider or metadata.provider()
+    discno, album = find_disc(rel, discid)
 
     relid = rel["id"]
-    ret = mb.get_release_by_id(
-        relid, includes=["artists", "recordings", "media", "artist-credits"]
+    ret = provider.get_release_by_id(
+        relid, includes=["artists", "recordings", "media", "artist-credits", "discids"]
     )
     rel = ret.get("release")
+    if rel["medium-count"] > 1:
+        boxset.remember_release(rel)
+
+    cover_art = None
+    if rel.get("cover-art-archive").get("artwork") == "true":
+        try:
+            art = provider.get_image_list(relid)
+            pos = 0
+            for img in art["images"]:
+                if not "Front" in img.get("types", []):
+                    continue
+
+                if not cover_art or pos == discno:
+                    cover_art = provider.get_image(img["image"])
 
+                if pos == discno:
+                    break
+
+                pos += 1
+        except Exception as e:
+            util.print_error()
+            pass
+
+    return cd_info_from_release(rel, discid, discno, album, cover_art)
+
+
+def cd_info_from_release(rel, discid, discno, album, cover_art):
+    """
+    Builds the CDInfo for one medium of a full release, as returned by the
+    provider's get_release_by_id(). Doesn't touch the network.
+    """
     date = rel["date"]
     fmts = [
         "%Y-%m-%d",
@@ -303,6 +415,8 @@ def get_cd_info(rel, discid):
             album=album,
             title=t.get("title") or t["recording"]["title"],
             trackno=int(t["position"]),
+            recording_id=t["recording"].get("id", ""),
+            track_id=t.get("id", ""),
         )
         atracks.append(track)
 
@@ -312,26 +426,6 @@ def get_cd_info(rel, discid):
 
     atracks = sorted(atracks, key=lambda t: t.trackno)
 
-    cover_art = None
-    if rel.get("cover-art-archive").get("artwork") == "true":
-        try:
-            art = mb.get_image_list(relid)
-            pos = 0
-            for img in art["images"]:
-                if not "Front" in img.get("types", []):
-                    continue
-
-                if not cover_art or pos == discno:
-                    cover_art = util.http_get(img["image"])
-
-                if pos == discno:
-                    break
-
-                pos += 1
-        except Exception as e:
-            util.print_error()
-            pass
-
     return CDInfo(
         artist=album_artist,
         album=album,
@@ -342,6 +436,8 @@ def get_cd_info(rel, discid):
         multi_artist=len(found_artists) > 1,
         cover_art=cover_art,
         disambiguation=rel.get("disambiguation"),
+        discid=discid,
+        release_id=rel["id"],
     )
 
 
@@ -349,15 +445,7 @@ if __name__ == "__main__":
     import sys
     import pprint
 
-    # Some interesting disc IDs:
-    # - dCZWjhrnNC_JSgv9lqSZQ_SPc3c- : normal album (Haken - Vector)
-    # - x0uC3CqZCMC8_Qr2OsgL59MkmYE- : second disc of double album (Joe Satriani - Live in SF)
-    # - kLu3X6F6GwZwCwvdhCVQs4R9iPc- : second disc with data track (The Ocean - Precambrian)
-    # - SCP4nE6BDCTkQnHMzs6LiBuHCdg- : multiple artists (Merry Axemas)
-    # - VsCC5lu9uDTPZO5uUG6BiQ_OziI- : re-issued + bonus tracks (King Diamond - Abigail)
-    # - 5vdHnGO7X5GvTQvzRhwMhGxW6_0- : release with a lot of stuff (Kate Bush - Hounds of Love)
-    # - RBiq_Z3vfD7L_dPbTCeeM3BL5mU- : part of a "remasters" collection (Judas Priest - Turbo)
-    discid = "dCZWjhrnNC_JSgv9lqSZQ_SPc3c-"
+    discid = next(iter(SAMPLE_DISCS))
 
     if sys.argv[-1] == "-d":
         discid = get_disc_info().discid
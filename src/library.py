@@ -0,0 +1,132 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+
+import detect
+import mutagen
+import ripper
+from mutagen import id3
+from mutagen.flac import FLAC
+from mutagen.mp3 import MP3
+
+# ID3 frames for the fields read back from tagged files. Vorbis comments use the
+# field names directly.
+ID3_FIELDS = {
+    "album": "TALB",
+    "artist": "TPE1",
+    "albumartist": "TPE2",
+    "title": "TIT2",
+    "tracknumber": "TRCK",
+    "discnumber": "TPOS",
+    "date": "TDRC",
+    "musicbrainz_albumid": "TXXX:MusicBrainz Album Id",
+    "musicbrainz_releasetrackid": "TXXX:MusicBrainz Release Track Id",
+    "musicbrainz_discid": "TXXX:MusicBrainz Disc Id",
+    "musicbrainz_toc": "TXXX:MusicBrainz TOC",
+}
+
+
+def _int(value, default):
+    try:
+        return int(str(value).split("/")[0])
+    except ValueError:
+        return default
+
+
+def read_tags(path):
+    """
+    Reads the tags fripper writes from a file, as a dict of strings keyed by
+    Vorbis comment name, plus the front cover under "cover_art".
+    """
+    f = mutagen.File(path)
+    if f is None:
+        raise Exception(f"unknown file format: {path}")
+
+    ret = {}
+    tags = f.tags or {}
+    if isinstance(f, MP3):
+        for name, frame in ID3_FIELDS.items():
+            if frame in tags:
+                ret[name] = str(tags[frame].text[0])
+
+        tpos = ret.get("discnumber", "")
+        if "/" in tpos:
+            ret["disctotal"] = tpos.split("/")[1]
+
+        ufid = tags.get(f"UFID:{ripper.MB_UFID_OWNER}")
+        if ufid:
+            ret["musicbrainz_trackid"] = ufid.data.decode("ascii")
+
+        pics = tags.getall("APIC")
+        front = [p for p in pics if p.type == id3.PictureType.COVER_FRONT]
+        if front or pics:
+            ret["cover_art"] = (front or pics)[0].data
+    else:
+        names = list(ID3_FIELDS) + ["disctotal", "totaldiscs", "musicbrainz_trackid"]
+        for name in names:
+            value = tags.get(name)
+            if value:
+                ret[name] = value[0]
+
+        if isinstance(f, FLAC) and f.pictures:
+            front = [p for p in f.pictures if p.type == id3.PictureType.COVER_FRONT]
+            ret["cover_art"] = (front or f.pictures)[0].data
+
+    return ret
+
+
+def read_album(paths):
+    """
+    Reads the tags of the files of one album directory into a CDInfo, whose
+    tracks are ordered like the returned list of paths.
+    """
+    tracks = []
+    disc = None
+    for path in paths:
+        tags = read_tags(path)
+
+        track = detect.TrackInfo(
+            artist=tags.get("artist", "Unknown"),
+            album=tags.get("album", "Unknown"),
+            title=tags.get("title") or os.path.splitext(os.path.basename(path))[0],
+            trackno=_int(tags.get("tracknumber", ""), len(tracks) + 1),
+            recording_id=tags.get("musicbrainz_trackid", ""),
+            track_id=tags.get("musicbrainz_releasetrackid", ""),
+        )
+        tracks.append((track, path))
+
+        if disc is None:
+            set_size = tags.get("disctotal") or tags.get("totaldiscs", "1")
+            disc = detect.CDInfo(
+                artist=tags.get("albumartist") or track.artist,
+                album=track.album,
+                tracks=[],
+                discno=_int(tags.get("discnumber", ""), 1),
+                year=_int(tags.get("date", "")[:4], 1900),
+                set_size=_int(set_size, 1),
+                multi_artist=False,
+                cover_art=tags.get("cover_art"),
+                discid=tags.get("musicbrainz_discid", ""),
+                release_id=tags.get("musicbrainz_albumid", ""),
+                toc=tags.get("musicbrainz_toc", ""),
+            )
+
+    tracks.sort(key=lambda t: t[0].trackno)
+    disc.tracks = [t for t, _ in tracks]
+    disc.multi_artist = len({t.artist for t in disc.tracks}) > 1
+    return disc, [p for _, p in tracks]
+
+
+def find_albums(source, exts):
+    """
+    Walks a library, returning the lists of files with the given extensions per
+    directory.
+    """
+    for root, dirs, files in os.walk(os.path.abspath(source)):
+        dirs.sort()
+        paths = [
+            os.path.join(root, f)
+            for f in sorted(files)
+            if os.path.splitext(f)[1].lower() in exts
+        ]
+        if paths:
+            yield paths
@@ -0,0 +1,509 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import base64
+import glob
+import gzip
+import json
+import lzma
+import os
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import musicbrainzngs as mb
+import requests
+import tracing
+import util
+
+USER_AGENT = ("fripper", "1.0")
+CAA_URL = "https://coverartarchive.org"
+INDEX_NAME = "mbindex.db"
+CORPUS_EXT = ".json.gz"
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS releases (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS discs (
+    discid TEXT NOT NULL,
+    release_id TEXT NOT NULL,
+    PRIMARY KEY (discid, release_id)
+);
+"""
+
+_provider = None
+_provider_lock = threading.Lock()
+
+
+class MusicBrainzProvider:
+    """
+    Queries the public musicbrainz service (or a mirror of it) through
+    musicbrainzngs. The public service is rate limited to one request per second.
+    """
+
+    parallel = False
+
+    def __init__(self, host=None, https=True):
+        mb.set_useragent(*USER_AGENT)
+        if host:
+            mb.set_hostname(host, use_https=https)
+            mb.set_rate_limit(False)
+            self.parallel = True
+
+    def get_releases_by_discid(self, discid):
+        return mb.get_releases_by_discid(discid)
+
+    def get_release_by_id(self, relid, includes):
+        return mb.get_release_by_id(relid, includes=includes)
+
+    def get_image_list(self, relid):
+        return mb.get_image_list(relid)
+
+    def get_image(self, url):
+        return util.http_get(url)
+
+
+class WebServiceProvider:
+    """
+    Queries a musicbrainz-compatible JSON web service, e.g. a self-hosted mirror
+    or the local stand-in server. No rate limiting is applied.
+    """
+
+    parallel = True
+
+    def __init__(self, url, caa_url=CAA_URL):
+        self.url = url.rstrip("/")
+        self.caa_url = caa_url.rstrip("/") if caa_url else None
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = "/".join(USER_AGENT)
+
+    def _get(self, path, **params):
+        params["fmt"] = "json"
+        res = self.session.get(f"{self.url}/ws/2/{path}", params=params)
+        if res.status_code == 404:
+            raise Exception(f"{path} not found")
+        res.raise_for_status()
+        return res.json()
+
+    def get_releases_by_discid(self, discid):
+        data = self._get(f"discid/{discid}", inc="discids")
+        releases = [release_to_mb(r) for r in data.get("releases", [])]
+        return {"disc": {"id": discid, "release-list": releases}}
+
+    def get_release_by_id(self, relid, includes):
+        data = self._get(f"release/{relid}", inc="+".join(includes))
+        return {"release": release_to_mb(data)}
+
+    def get_image_list(self, relid):
+        if not self.caa_url:
+            return {"images": []}
+        res = self.session.get(f"{self.caa_url}/release/{relid}")
+        res.raise_for_status()
+        return res.json()
+
+    def get_image(self, url):
+        res = self.session.get(url)
+        res.raise_for_status()
+        return res.content
+
+
+class IndexProvider:
+    """
+    Answers queries from a local SQLite index built from musicbrainz JSON dumps.
+    Cover art is not available locally.
+    """
+
+    parallel = True
+
+    def __init__(self, path=None):
+        self.index = ReleaseIndex(path)
+
+    def get_releases_by_discid(self, discid):
+        releases = [release_to_mb(r) for r in self.index.by_discid(discid)]
+        return {"disc": {"id": discid, "release-list": releases}}
+
+    def get_release_by_id(self, relid, includes):
+        rel = self.index.by_id(relid)
+        if not rel:
+            raise Exception(f"release {relid} not found")
+        return {"release": release_to_mb(rel)}
+
+    def get_image_list(self, relid):
+        return {"images": []}
+
+    def get_image(self, url):
+        return util.http_get(url)
+
+
+class TracedProvider:
+    """
+    Wraps a provider, recording its calls in the trace.
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.parallel = provider.parallel
+
+    def get_releases_by_discid(self, discid):
+        with tracing.span("get_releases_by_discid", cat="net", discid=discid):
+            return self.provider.get_releases_by_discid(discid)
+
+    def get_release_by_id(self, relid, includes):
+        with tracing.span("get_release_by_id", cat="net", release=relid):
+            return self.provider.get_release_by_id(relid, includes)
+
+    def get_image_list(self, relid):
+        with tracing.span("get_image_list", cat="net", release=relid):
+            return self.provider.get_image_list(relid)
+
+    def get_image(self, url):
+        with tracing.span("get_image", cat="net", url=url):
+            return self.provider.get_image(url)
+
+
+class RecordingProvider:
+    """
+    Wraps a provider, keeping its responses so they can be saved to a corpus file
+    and served later by ReplayProvider.
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.parallel = provider.parallel
+        self.responses = {}
+        self.lock = threading.Lock()
+
+    def _record(self, key, value):
+        with self.lock:
+            self.responses[key] = value
+        return value
+
+    def get_releases_by_discid(self, discid):
+        ret = self.provider.get_releases_by_discid(discid)
+        return self._record(_call_key("get_releases_by_discid", discid), ret)
+
+    def get_release_by_id(self, relid, includes):
+        ret = self.provider.get_release_by_id(relid, includes)
+        return self._record(_call_key("get_release_by_id", relid, includes), ret)
+
+    def get_image_list(self, relid):
+        ret = self.provider.get_image_list(relid)
+        return self._record(_call_key("get_image_list", relid), ret)
+
+    def get_image(self, url):
+        ret = self.provider.get_image(url)
+        self._record(_call_key("get_image", url), base64.b64encode(ret).decode())
+        return ret
+
+    def save(self, path):
+        with self.lock:
+            data = {"parallel": self.parallel, "responses": self.responses}
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+
+
+class ReplayProvider:
+    """
+    Serves responses from corpus files saved by RecordingProvider: a single file,
+    or all files in a directory. Every call can be delayed to simulate network
+    latency. Calls that weren't recorded fail, like lookups of unknown IDs. If
+    "parallel" is given, it overrides whether the recorded source allowed
+    parallel requests.
+    """
+
+    def __init__(self, path, latency=0, parallel=None):
+        paths = [path]
+        if os.path.isdir(path):
+            paths = sorted(glob.glob(os.path.join(path, f"*{CORPUS_EXT}")))
+
+        self.parallel = True
+        self.responses = {}
+        for p in paths:
+            with open_dump(p) as f:
+                data = json.load(f)
+            self.parallel = self.parallel and data.get("parallel", True)
+            # Kept serialized, so that every call pays for parsing a response
+            # like it would with a real service.
+            for key, value in data["responses"].items():
+                self.responses[key] = json.dumps(value)
+
+        if parallel is not None:
+            self.parallel = parallel
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def _replay(self, key):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        data = self.responses.get(key)
+        if data is None:
+            raise Exception(f"no recorded response for {key}")
+        return json.loads(data)
+
+    def get_releases_by_discid(self, discid):
+        return self._replay(_call_key("get_releases_by_discid", discid))
+
+    def get_release_by_id(self, relid, includes):
+        return self._replay(_call_key("get_release_by_id", relid, includes))
+
+    def get_image_list(self, relid):
+        return self._replay(_call_key("get_image_list", relid))
+
+    def get_image(self, url):
+        return base64.b64decode(self._replay(_call_key("get_image", url)))
+
+
+def _call_key(method, *args):
+    return json.dumps([method] + list(args))
+
+
+class ReleaseIndex:
+    """
+    SQLite index of releases in the musicbrainz JSON format, keyed by release
+    and disc ID. Connections are per thread so the index can be shared by
+    concurrent lookups.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or util.data_path(INDEX_NAME)
+        self.local = threading.local()
+        self.db.executescript(INDEX_SCHEMA)
+
+    @property
+    def db(self):
+        db = getattr(self.local, "db", None)
+        if not db:
+            db = sqlite3.connect(self.path)
+            self.local.db = db
+        return db
+
+    def by_id(self, relid):
+        row = self.db.execute("SELECT data FROM releases WHERE id = ?", (relid,))
+        row = row.fetchone()
+        return json.loads(row[0]) if row else None
+
+    def by_discid(self, discid):
+        rows = self.db.execute(
+            "SELECT r.data FROM discs d JOIN releases r ON r.id = d.release_id "
+            "WHERE d.discid = ?",
+            (discid,),
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    def add(self, rel):
+        self.db.execute(
+            "INSERT OR REPLACE INTO releases VALUES (?, ?)",
+            (rel["id"], json.dumps(rel)),
+        )
+        for medium in rel.get("media", []):
+            for disc in medium.get("discs", []):
+                self.db.execute(
+                    "INSERT OR REPLACE INTO discs VALUES (?, ?)",
+                    (disc["id"], rel["id"]),
+                )
+
+    def import_dump(self, path):
+        """
+        Imports releases from a musicbrainz JSON dump (one release per line; may be
+        gzip or xz compressed). Only releases with disc IDs are kept. Returns the
+        number of releases added. Malformed lines are skipped and counted; if no
+        line can be parsed, an exception is raised.
+        """
+        count = parsed = bad = 0
+        with open_dump(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rel = json.loads(line)
+                    has_discs = any(m.get("discs") for m in rel.get("media", []))
+                    if has_discs:
+                        self.add(rel)
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    bad += 1
+                    continue
+
+                parsed += 1
+                if has_discs:
+                    count += 1
+
+        if bad and not parsed:
+            raise Exception(f"{path} is not a musicbrainz JSON dump")
+        if bad:
+            print(f"Skipped {bad} malformed lines in {path}.")
+
+        self.db.commit()
+        return count
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    Minimal musicbrainz web service stand-in serving discid and release lookups
+    from a ReleaseIndex, in JSON format. Useful for tests and for sharing an index
+    with other stations on the LAN.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, index, address=("127.0.0.1", 0)):
+        self.index = index
+        super().__init__(address, _StandInHandler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?")[0].strip("/").split("/")
+        data = None
+        if len(path) == 4 and path[:2] == ["ws", "2"]:
+            kind, key = path[2:]
+            if kind == "release":
+                data = self.server.index.by_id(key)
+            elif kind == "discid":
+                releases = self.server.index.by_discid(key)
+                if releases:
+                    data = {"id": key, "releases": releases}
+
+        if data is None:
+            self.send_error(404)
+            return
+
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def open_dump(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.endswith(".xz"):
+        return lzma.open(path, "rt", encoding="utf-8")
+    return open(path, "rt", encoding="utf-8")
+
+
+def artist_credit_to_mb(credits):
+    ret = []
+    for c in credits or []:
+        ret.append({"artist": c["artist"], "name": c.get("name")})
+        if c.get("joinphrase"):
+            ret.append(c["joinphrase"])
+    return ret
+
+
+def release_to_mb(rel):
+    """
+    Converts a release in the musicbrainz JSON format to the structure returned
+    by musicbrainzngs, which is what detect.get_cd_info() understands.
+    """
+    media = []
+    for m in rel.get("media", []):
+        tracks = []
+        for t in m.get("tracks", []):
+            recording = t.get("recording", {})
+            credit = t.get("artist-credit") or recording.get("artist-credit")
+            tracks.append(
+                {
+                    "id": t.get("id"),
+                    "position": str(t["position"]),
+                    "number": t.get("number"),
+                    "title": t.get("title"),
+                    "artist-credit": artist_credit_to_mb(credit),
+                    "recording": {
+                        "id": recording.get("id"),
+                        "title": recording.get("title"),
+                    },
+                }
+            )
+        medium = {
+            "position": str(m["position"]),
+            "disc-list": [{"id": d["id"]} for d in m.get("discs", [])],
+            "track-list": tracks,
+        }
+        if m.get("title"):
+            medium["title"] = m["title"]
+        media.append(medium)
+
+    caa = rel.get("cover-art-archive", {})
+    return {
+        "id": rel["id"],
+        "title": rel.get("title"),
+        "date": rel.get("date") or "",
+        "disambiguation": rel.get("disambiguation", ""),
+        "artist-credit": artist_credit_to_mb(rel.get("artist-credit")),
+        "medium-count": len(media),
+        "medium-list": media,
+        "cover-art-archive": {
+            "artwork": "true" if caa.get("artwork") else "false",
+        },
+    }
+
+
+def create_provider(spec):
+    """
+    Creates a provider from a spec string: empty for musicbrainz.org, an
+    "http(s)://" URL for a JSON web service, "mb://host" for a musicbrainz mirror
+    accessed through musicbrainzngs, "replay:path" for recorded responses, or the
+    path to a local SQLite index.
+    """
+    if not spec:
+        return MusicBrainzProvider()
+    if spec.startswith("replay:"):
+        return ReplayProvider(spec[7:])
+    if spec.startswith("http://") or spec.startswith("https://"):
+        return WebServiceProvider(spec)
+    if spec.startswith("mb://"):
+        return MusicBrainzProvider(host=spec[5:], https=False)
+    return IndexProvider(spec)
+
+
+def provider():
+    global _provider
+    with _provider_lock:
+        if not _provider:
+            _provider = create_provider(util.SETTINGS.value("fripper/metadata"))
+            if tracing.enabled():
+                _provider = TracedProvider(_provider)
+        return _provider
+
+
+def set_provider(p):
+    global _provider
+    with _provider_lock:
+        _provider = p
+
+
+if __name__ == "__main__":
+    import sys
+
+    # Usage: metadata.py serve [index] [port]
+    #        metadata.py import <dump> [index]
+    if len(sys.argv) >= 3 and sys.argv[1] == "import":
+        index = ReleaseIndex(sys.argv[3] if len(sys.argv) > 3 else None)
+        print(f"Imported {index.import_dump(sys.argv[2])} releases.")
+    elif len(sys.argv) >= 2 and sys.argv[1] == "serve":
+        index = ReleaseIndex(sys.argv[2] if len(sys.argv) > 2 else None)
+        port = int(sys.argv[3]) if len(sys.argv) > 3 else 5000
+        server = StandInServer(index, ("0.0.0.0", port))
+        print(f"Serving on {server.url}")
+        server.serve_forever()
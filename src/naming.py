@@ -0,0 +1,252 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import functools
+import os
+import string
+
+import cdinfo
+
+# Fields available in file name templates.
+FIELDS = ("artist", "album", "discno", "trackno", "track", "ext")
+
+# Fallback limits, in bytes, when the target file system can't be queried.
+NAME_MAX = 255
+PATH_MAX = 4096
+
+
+@functools.lru_cache(maxsize=None)
+def compile_template(template):
+    """
+    Returns the compiled version of a file name template. Templates are compiled
+    once and cached.
+    """
+    return Template(template)
+
+
+class Template:
+    """
+    A compiled file name template.
+
+    Templates use str.format() syntax, with the fields in FIELDS. Sections within
+    angle brackets are conditional: they're only expanded if all the fields they
+    use have a value. {discno} only has a value there for multi-disc sets, so e.g.
+    "{artist}/{album}/<{discno}->{trackno} {track}.{ext}" only prefixes track
+    numbers with the disc number for multi-disc sets.
+    """
+
+    def __init__(self, template):
+        if not template:
+            raise Exception("empty file name template")
+        if template.startswith("/"):
+            raise Exception("file name template must be a relative path")
+
+        self.template = template
+        self.sections = []
+        for conditional, text in _split_sections(template):
+            parts = []
+            for literal, field, spec, conversion in string.Formatter().parse(text):
+                name = None
+                if field is not None:
+                    # Only the base name is checked, so that indexing and
+                    # attributes (e.g. "{artist[0]}") work like in str.format().
+                    name = field.split(".", 1)[0].split("[", 1)[0]
+                    if name not in FIELDS:
+                        raise Exception(f"unknown field in file name template: {name}")
+                    if spec and "{" in spec:
+                        raise Exception("nested fields in file name template")
+                parts.append((literal, field, spec, conversion, name))
+            self.sections.append((conditional, parts))
+
+    def expand(self, disc, track, ext):
+        """
+        Returns the relative path for a track.
+        """
+        variables = cdinfo.dest_fmt_variables(disc, track, ext)
+        absent = {k for k, v in variables.items() if v is None or v == ""}
+        if disc.set_size <= 1:
+            absent.add("discno")
+
+        ret = []
+        for conditional, parts in self.sections:
+            if conditional and any(p[4] in absent for p in parts):
+                continue
+            for literal, field, spec, conversion, name in parts:
+                ret.append(literal)
+                if field is not None:
+                    value = string.Formatter().get_field(field, (), variables)[0]
+                    if conversion:
+                        value = string.Formatter().convert_field(value, conversion)
+                    ret.append(format(value, spec or ""))
+        return "".join(ret)
+
+    def plan(self, disc, ext, target=None, exclude=(), extras=()):
+        """
+        Expands the template for all of the disc's tracks, returning their relative
+        paths. Raises an exception listing all problems found: invalid or too long
+        path components, tracks mapping to the same file, and, if target is given,
+        files that already exist in the library. Files in "exclude" (e.g. the ones
+        being retagged) may exist. "extras" are the names of other files written
+        next to the first track, like the cue sheet, which are checked as well.
+        """
+        try:
+            paths = [self.expand(disc, t, ext) for t in disc.tracks]
+        except (ValueError, TypeError, IndexError, KeyError, AttributeError) as e:
+            raise Exception(f"invalid file name template: {e}")
+
+        name_max, path_max = _limits(target)
+        fold = _case_insensitive(target)
+        exclude = {os.path.abspath(p) for p in exclude}
+        problems = []
+        seen = {}
+        for t, path in zip(disc.tracks, paths):
+            for name in path.split("/"):
+                if name in ("", ".", ".."):
+                    problems.append(f"track {t.trackno}: invalid path {path!r}")
+                    break
+                if len(os.fsencode(name)) > name_max:
+                    problems.append(f"track {t.trackno}: name too long: {name}")
+
+            full = os.path.join(target, path) if target else path
+            if len(os.fsencode(full)) > path_max:
+                problems.append(f"track {t.trackno}: path too long: {full}")
+
+            # Names differing only in case collide on file systems like FAT or
+            # NTFS, but are distinct files elsewhere.
+            key = path.casefold() if fold else path
+            if key in seen:
+                problems.append(
+                    f"tracks {seen[key]} and {t.trackno} map to the same file: {path}"
+                )
+            else:
+                seen[key] = t.trackno
+
+            if target and os.path.exists(full) and os.path.abspath(full) not in exclude:
+                problems.append(f"track {t.trackno}: {full} already exists")
+
+        album_dir = os.path.dirname(paths[0]) if paths else ""
+        for name in extras:
+            if len(os.fsencode(name)) > name_max:
+                problems.append(f"name too long: {name}")
+            full = os.path.join(target or "", album_dir, name)
+            if target and os.path.exists(full) and os.path.abspath(full) not in exclude:
+                problems.append(f"{full} already exists")
+
+        if problems:
+            raise Exception("\n".join(problems))
+        return paths
+
+
+def cue_name(disc):
+    """
+    Returns the name of the disc's cue sheet, named after the album so that
+    albums sharing a directory don't collide.
+    """
+    name = disc.album.translate(cdinfo.FS_SAFE) or "disc"
+    if disc.set_size > 1:
+        name = f"{name} (disc {disc.discno})"
+    return f"{name}.cue"
+
+
+def stats_name(disc):
+    """
+    Returns the name of the rip's stats file, named after the disc ID so that
+    discs sharing a directory don't collide.
+    """
+    if disc.discid:
+        return f"rip-stats-{disc.discid}.json"
+    return f"rip-stats-disc{disc.discno}.json"
+
+
+def _split_sections(template):
+    """
+    Splits a template into (conditional, text) sections. Angle brackets within
+    replacement fields (e.g. alignment in format specs) are not section markers.
+    """
+    sections = []
+    text = ""
+    conditional = False
+    depth = 0
+    i = 0
+    while i < len(template):
+        c = template[i]
+        if c in "{}" and template[i : i + 2] == c * 2 and depth == 0:
+            text += c * 2
+            i += 2
+            continue
+
+        if c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+        elif depth == 0 and c == "<":
+            if conditional:
+                raise Exception("nested conditional sections in file name template")
+            if text:
+                sections.append((False, text))
+            text = ""
+            conditional = True
+            i += 1
+            continue
+        elif depth == 0 and c == ">":
+            if not conditional:
+                raise Exception("unbalanced '>' in file name template")
+            sections.append((True, text))
+            text = ""
+            conditional = False
+            i += 1
+            continue
+
+        text += c
+        i += 1
+
+    if conditional:
+        raise Exception("unbalanced '<' in file name template")
+    if text:
+        sections.append((False, text))
+    return sections
+
+
+def _existing_dir(target):
+    """
+    Returns the closest existing directory to the target, or None.
+    """
+    path = target
+    while path and not os.path.isdir(path):
+        path = os.path.dirname(path)
+    return path or None
+
+
+def _limits(target):
+    """
+    Returns the file name and path length limits for the target directory.
+    """
+    try:
+        path = _existing_dir(target)
+        if path:
+            return os.pathconf(path, "PC_NAME_MAX"), os.pathconf(path, "PC_PATH_MAX")
+    except (OSError, ValueError, AttributeError):
+        pass
+    return NAME_MAX, PATH_MAX
+
+
+def _case_insensitive(target):
+    """
+    Returns whether the target directory is on a case-insensitive file system, by
+    looking up an existing directory with the case of its name swapped. Targets
+    that can't be checked are assumed to be case-sensitive.
+    """
+    path = _existing_dir(target)
+    if not path:
+        return False
+
+    path = os.path.abspath(path)
+    while True:
+        head, name = os.path.split(path)
+        if name.swapcase() != name:
+            swapped = os.path.join(head, name.swapcase())
+            try:
+                return os.path.samefile(path, swapped)
+            except OSError:
+                return False
+        if not name:
+            return False
+        path = head
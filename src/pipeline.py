@@ -0,0 +1,596 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import asyncio
+import contextlib
+import os
+import shlex
+import time
+import wave
+
+import cdinfo
+import cdreader
+import remote
+import scheduling
+import speed
+import telemetry
+import tocdb
+import tracing
+import util
+import verify
+
+CDPARANOIA_CMD = "cdparanoia -e --abort-on-skip --never-skip=10 {trackno} {output}"
+WHOLE_DISC_CMD = "cdparanoia -e --abort-on-skip --never-skip=10 -r 1- -"
+EXT = "mp3"
+
+# CD-DA sector size, and number of sectors read from the whole-disc stream at once.
+SECTOR_SIZE = 2352
+READ_SECTORS = 75
+
+# Limit for a single line of process output.
+LINE_LIMIT = 1024 * 1024
+
+
+class Listener:
+    """
+    Receives pipeline events. Methods are called from the pipeline's thread.
+    """
+
+    def rip_output(self, line):
+        pass
+
+    def ripped(self, track, fname):
+        pass
+
+    def rip_stats(self, stats):
+        pass
+
+    def encode_output(self, line):
+        pass
+
+    def encoded(self, track, fname):
+        pass
+
+    def error(self, msg):
+        pass
+
+
+class Pipeline:
+    """
+    Rips and encodes a disc from a single asyncio event loop. The ripper feeds a
+    bounded queue that is drained by one or more encoder workers; all child
+    processes are managed through non-blocking pipes.
+
+    run() should be called from the thread that owns the loop (e.g. through
+    asyncio.run()); cancel() can be called from any thread.
+    """
+
+    def __init__(
+        self,
+        disc,
+        config,
+        workdir,
+        listener,
+        tagger,
+        encoders=1,
+        timeout=None,
+        workers=(),
+    ):
+        self.disc = disc
+        self.config = config
+        self.workdir = workdir
+        self.listener = listener
+        self.tagger = tagger
+        self.workers = [remote.RemoteEncoder(w, timeout) for w in workers]
+        self.encoders = max(1 if not self.workers else 0, encoders)
+        self.timeout = timeout
+        self.cancelled = False
+        self.stats = []
+        self.speed = None
+        self.policies = scheduling.policies(
+            config.scheduling or {}, config.reserve_reader_core
+        )
+        self.verifiers = 0
+        if config.verify:
+            self.verifiers = config.verifiers or os.cpu_count() or 1
+        self.verify_queue = None
+        self.encoding = 0
+        self.loop = None
+        self.main = None
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.main = asyncio.current_task()
+        if self.cancelled:
+            return False
+
+        # Sized so that the ripper never blocks on slow encoders: stalling the
+        # reader would make the drive spin down.
+        queue = asyncio.Queue(maxsize=len(self.disc.tracks) + self.encode_tasks)
+        tasks = [asyncio.create_task(self._rip(queue))]
+        for _ in range(self.encoders):
+            tasks.append(asyncio.create_task(self._encode(queue)))
+        for w in self.workers:
+            tasks.append(asyncio.create_task(self._encode(queue, w)))
+
+        # Verification runs in its own pool, so encoded files are checked while
+        # the remaining tracks are still being ripped and encoded.
+        self.encoding = self.encode_tasks
+        if self.verifiers:
+            self.verify_queue = asyncio.Queue()
+            for _ in range(self.verifiers):
+                tasks.append(asyncio.create_task(self._verify(self.verify_queue)))
+
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for t in done:
+                if t.exception():
+                    raise t.exception()
+            return True
+        except asyncio.CancelledError:
+            return False
+        except Exception as e:
+            util.print_error()
+            self.listener.error(str(e))
+            return False
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    @property
+    def encode_tasks(self):
+        return self.encoders + len(self.workers)
+
+    def cancel(self):
+        self.cancelled = True
+        if self.loop and self.main:
+            self.loop.call_soon_threadsafe(self.main.cancel)
+
+    async def _rip(self, queue):
+        if self.config.auto_speed:
+            drive = await self.loop.run_in_executor(None, telemetry.drive_id)
+            self.speed = speed.SpeedController(speed.SpeedStore(), drive)
+            self.listener.rip_output(f"==== Read speed: {self.speed.describe()}")
+
+        try:
+            await self._rip_all(queue)
+        finally:
+            if self.speed and not util.TEST_MODE:
+                self.speed.store.save()
+
+    async def _rip_all(self, queue):
+        if self.config.native_reader and self.disc.toc:
+            await self._rip_native(queue)
+        elif self.config.whole_disc and self.disc.toc:
+            await self._rip_disc(queue)
+        else:
+            await self._rip_tracks(queue)
+
+        for _ in range(self.encode_tasks):
+            await queue.put(None)
+
+    async def _rip_tracks(self, queue):
+        ranges = self._track_ranges()
+        for t in self.disc.tracks:
+            target = f"track{t.trackno}.wav"
+
+            cmd = with_speed(CDPARANOIA_CMD, self.speed)
+            if util.TEST_MODE:
+                cmd = "touch {output}"
+
+            log = telemetry.ParanoiaLog()
+            out = self.listener.rip_output
+
+            def output(line):
+                if not log.feed(line):
+                    out(line)
+
+            out(f"==== Ripping track {t.trackno} - {t.title}")
+            with tracing.task_span(f"rip track {t.trackno}", cat="rip"):
+                await self._exec("rip", t, cmd, None, target, output)
+            self._rip_done(t, log.stats(t.trackno, *ranges.get(t.trackno, ())))
+            self.listener.ripped(t, target)
+            await queue.put((t, target))
+
+    def _rip_done(self, track, stats, adapt=True):
+        self.stats.append(stats)
+        self.listener.rip_output(f"--- Done ({stats.summary()}).")
+        self.listener.rip_stats(stats)
+
+        if self.speed and not adapt:
+            self.speed.record(stats)
+        elif self.speed and self.speed.update(stats):
+            self.listener.rip_output(
+                f"--- Too many re-reads, slowing down to {self.speed.describe()}."
+            )
+
+    async def _rip_disc(self, queue):
+        """
+        Reads the whole disc in a single cdparanoia run, splitting the PCM stream
+        into per-track WAV files at the TOC's sector boundaries. Each track is
+        handed to the encoders as soon as its last sector is read.
+        """
+        tracks = self.disc.tracks
+        offsets, sizes = self._track_sectors()
+
+        # The speed can't change in the middle of the read; it's only recorded.
+        cmd = shlex.split(with_speed(WHOLE_DISC_CMD, self.speed))
+        if util.TEST_MODE:
+            total = sum(sizes) * SECTOR_SIZE
+            cmd = ["head", "-c", str(total), "/dev/zero"]
+
+        timeout = self.timeout * len(tracks) if self.timeout else None
+        out = self.listener.rip_output
+        out(f"==== Ripping disc ({len(tracks)} tracks)")
+
+        log = telemetry.ParanoiaLog()
+
+        def output(line):
+            if not log.feed(line):
+                out(line)
+
+        async with self._process("rip", cmd, stderr=asyncio.subprocess.PIPE) as proc:
+            progress = asyncio.create_task(_read_lines(proc.stderr, output))
+
+            async def split():
+                first = 0
+                for t, sectors in zip(tracks, sizes):
+                    target = f"track{t.trackno}.wav"
+                    out(f"==== Track {t.trackno} - {t.title}")
+                    start = time.monotonic()
+                    with tracing.task_span(f"rip track {t.trackno}", cat="rip"):
+                        await self._write_track(proc.stdout, target, sectors)
+
+                    lsn = offsets[0] - cdreader.LBA_OFFSET + first
+                    elapsed = time.monotonic() - start
+                    stats = log.stats(t.trackno, lsn, sectors, elapsed)
+                    self._rip_done(t, stats, adapt=False)
+                    first += sectors
+
+                    self.listener.ripped(t, target)
+                    await queue.put((t, target))
+
+                await progress
+                return await proc.wait()
+
+            try:
+                ec = await asyncio.wait_for(split(), timeout)
+            except asyncio.TimeoutError:
+                raise Exception(f"process {cmd[0]} timed out")
+            finally:
+                progress.cancel()
+
+        if ec != 0:
+            raise Exception(f"process {cmd[0]} exited with {ec}")
+
+    async def _rip_native(self, queue):
+        """
+        Reads audio in-process through libcdio, one track at a time, in a worker
+        thread so the loop stays responsive.
+        """
+        out = self.listener.rip_output
+        offsets, sizes = self._track_sectors()
+
+        if util.TEST_MODE:
+            source = cdreader.ImageSource()
+        else:
+            source = cdreader.DeviceSource()
+        reader = cdreader.NativeReader(source)
+
+        try:
+            for t, lba, sectors in zip(self.disc.tracks, offsets, sizes):
+                target = f"track{t.trackno}.wav"
+                out(f"==== Ripping track {t.trackno} - {t.title}")
+                if self.speed:
+                    source.set_speed(self.speed.current)
+
+                work = self.loop.run_in_executor(
+                    None, self._read_track, t, reader, lba, sectors, target
+                )
+                try:
+                    stats = await asyncio.shield(work)
+                except asyncio.CancelledError:
+                    reader.cancel()
+                    await asyncio.gather(work, return_exceptions=True)
+                    raise
+
+                self._rip_done(t, telemetry.from_read_stats(t.trackno, stats))
+                self.listener.ripped(t, target)
+                await queue.put((t, target))
+        finally:
+            source.close()
+
+    def _read_track(self, track, reader, lba, sectors, target):
+        path = os.path.join(self.workdir, target)
+        with tracing.span(f"rip track {track.trackno}", cat="rip"):
+            with wave.open(path, "wb") as w:
+                w.setnchannels(2)
+                w.setsampwidth(2)
+                w.setframerate(44100)
+                return reader.read(lba, sectors, w.writeframesraw)
+
+    def _track_ranges(self):
+        """
+        Returns the (first LSN, sector count) of each track by track number, or an
+        empty dict if the TOC is not known.
+        """
+        if not self.disc.toc:
+            return {}
+        try:
+            offsets, sizes = self._track_sectors()
+        except Exception:
+            return {}
+
+        return {
+            t.trackno: (lba - cdreader.LBA_OFFSET, sectors)
+            for t, lba, sectors in zip(self.disc.tracks, offsets, sizes)
+        }
+
+    def _track_sectors(self):
+        """
+        Returns the start LBA and length in sectors of each track, from the TOC.
+        """
+        tracks = self.disc.tracks
+        offsets, leadout = tocdb.parse_toc(self.disc.toc)
+        if len(offsets) != len(tracks):
+            raise Exception(
+                f"TOC has {len(offsets)} tracks, but disc info has {len(tracks)}"
+            )
+
+        sizes = [b - a for a, b in zip(offsets, offsets[1:] + [leadout])]
+        return offsets, sizes
+
+    async def _write_track(self, stream, target, sectors):
+        with wave.open(os.path.join(self.workdir, target), "wb") as w:
+            w.setnchannels(2)
+            w.setsampwidth(2)
+            w.setframerate(44100)
+
+            while sectors:
+                count = min(sectors, READ_SECTORS)
+                try:
+                    data = await stream.readexactly(count * SECTOR_SIZE)
+                except asyncio.IncompleteReadError:
+                    raise Exception(f"short read while ripping {target}")
+                w.writeframesraw(data)
+                sectors -= count
+
+    async def _encode(self, queue, worker=None):
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+
+            track, source = item
+            await self.encode(source, track, worker)
+
+        self.encoding -= 1
+        if self.verify_queue and not self.encoding:
+            for _ in range(self.verifiers):
+                await self.verify_queue.put(None)
+
+    async def encode(self, source, track, worker=None):
+        with tracing.task_span(f"encode track {track.trackno}", cat="encode"):
+            await self._encode_track(source, track, worker)
+
+    async def _encode_track(self, source, track, worker):
+        out = self.listener.encode_output
+        out(f"==== Encoding track {track.trackno} - {track.title}")
+
+        target = f"{source}.{EXT}"
+        if worker and not worker.failed:
+            try:
+                await worker.encode(self.workdir, source, target, track, out)
+            except Exception as e:
+                util.print_error()
+                out(f"--- {worker.name} failed ({e}), encoding locally.")
+                worker.failed = True
+
+        if not worker or worker.failed:
+            cmd = self.config.encoder
+            await self._exec("encode", track, cmd, source, target, out)
+
+        out(f"--- Tagging...")
+        try:
+            await self.loop.run_in_executor(None, self._tag, target, track)
+        except Exception as e:
+            raise Exception(f"error tagging {target}: {e}") from e
+
+        out(f"--- Done.")
+        if self.verify_queue:
+            await self.verify_queue.put((track, source, target))
+        else:
+            self.listener.encoded(track, target)
+
+    async def _verify(self, queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+
+            track, source, target = item
+            with tracing.task_span(f"verify track {track.trackno}", cat="verify"):
+                await self.verify(source, target, track)
+            self.listener.encoded(track, target)
+
+    async def verify(self, source, target, track):
+        """
+        Decodes an encoded file and checks it against the ripped audio: sample
+        count and duration, and for lossless formats, a checksum of the samples.
+        """
+        out = self.listener.encode_output
+        if util.TEST_MODE:
+            out(f"--- Skipped verifying track {track.trackno} in test mode.")
+            return
+
+        path = os.path.join(self.workdir, target)
+        fmt = await self.loop.run_in_executor(None, verify.file_format, path)
+        cmd = verify.DECODE_CMDS.get(fmt)
+        if not cmd:
+            out(f"--- Cannot verify track {track.trackno}: unknown format.")
+            return
+
+        decoded = f"{source}.verify.wav"
+        try:
+            await self._exec("verify", track, cmd, target, decoded, out)
+            summary = await self.loop.run_in_executor(
+                None,
+                verify.compare,
+                os.path.join(self.workdir, source),
+                os.path.join(self.workdir, decoded),
+                path,
+                fmt,
+            )
+        except Exception as e:
+            raise Exception(f"error verifying track {track.trackno}: {e}") from e
+        finally:
+            try:
+                os.unlink(os.path.join(self.workdir, decoded))
+            except FileNotFoundError:
+                pass
+
+        out(f"--- Verified track {track.trackno} ({summary}).")
+
+    def _tag(self, target, track):
+        with tracing.span(f"tag track {track.trackno}", cat="tag"):
+            self.tagger.tag(target, track)
+
+    async def _exec(self, stage, track, cmd, inf, outf, output):
+        """
+        Runs a command for the given stage, forwarding its output line by line.
+        The process is killed if the pipeline is cancelled or the timeout expires.
+        """
+        variables = cdinfo.cmd_fmt_variables(track, self.workdir, inf, outf, EXT)
+        cmd = [arg.format(**variables) for arg in shlex.split(cmd)]
+
+        if util.TEST_MODE:
+            await asyncio.sleep(1)
+
+        await run_command(cmd, output, self.timeout, self.policies.get(stage))
+
+    def _process(self, stage, cmd, stderr=asyncio.subprocess.STDOUT):
+        return process(cmd, stderr=stderr, policy=self.policies.get(stage))
+
+
+def with_speed(cmd, controller):
+    """
+    Adds the controller's current read speed to a cdparanoia command.
+    """
+    if not controller or not controller.current:
+        return cmd
+    return cmd.replace("cdparanoia ", f"cdparanoia -S {controller.current} ", 1)
+
+
+@contextlib.asynccontextmanager
+async def process(cmd, stderr=asyncio.subprocess.STDOUT, policy=None):
+    """
+    Starts a child process with a piped stdout, making sure it's killed and
+    reaped when the context exits. The scheduling policy, if any, is applied
+    through wrapper commands; the trace shows the wrapped command.
+    """
+    args = policy.command(cmd) if policy else cmd
+
+    start = tracing.now()
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=stderr,
+        limit=LINE_LIMIT,
+    )
+
+    try:
+        yield proc
+    finally:
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+        tracing.process(proc.pid, cmd, start, proc.returncode)
+
+
+async def run_command(cmd, output, timeout=None, policy=None):
+    """
+    Runs a command to completion, forwarding its output line by line. Raises an
+    exception if it fails or doesn't finish within the timeout.
+    """
+    async with process(cmd, policy=policy) as proc:
+        try:
+            await asyncio.wait_for(_read_lines(proc.stdout, output), timeout)
+            ec = await proc.wait()
+        except asyncio.TimeoutError:
+            raise Exception(f"process {cmd[0]} timed out")
+
+    if ec != 0:
+        raise Exception(f"process {cmd[0]} exited with {ec}")
+
+
+async def _read_lines(stream, output):
+    """
+    Forwards a process's output line by line. Like text mode pipes, both "\\r"
+    and "\\n" end a line, so that progress meters are forwarded as they update.
+    """
+    buf = b""
+    while True:
+        data = await stream.read(4096)
+        if not data:
+            break
+
+        data = (buf + data).replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        lines = data.split(b"\n")
+        buf = lines.pop()
+        for line in lines:
+            output(line.decode("utf-8", errors="replace"))
+
+    if buf:
+        output(buf.decode("utf-8", errors="replace"))
+
+
+def write_cue(disc, path, files=None):
+    """
+    Writes a cue sheet for the disc with one file per track. "files" maps track
+    numbers to file names, defaulting to the names of the ripped WAV files.
+
+    Tracks are split at the INDEX 01 offsets in the TOC, so each track's pregap
+    (which the TOC doesn't describe) stays at the end of the previous file.
+    Track 1's pregap is not ripped; its length comes from the TOC and is recorded
+    as silence. Together with the file lengths, this reproduces the disc's
+    layout. Raises an exception if the TOC doesn't match the tracks.
+    """
+
+    def quote(s):
+        return '"' + str(s).replace('"', "'") + '"'
+
+    def msf(sectors):
+        return f"{sectors // 4500:02}:{sectors // 75 % 60:02}:{sectors % 75:02}"
+
+    offsets = None
+    if disc.toc:
+        offsets, leadout = tocdb.parse_toc(disc.toc)
+        if len(offsets) != len(disc.tracks):
+            raise Exception(
+                f"TOC has {len(offsets)} tracks, but disc info has {len(disc.tracks)}"
+            )
+
+    lines = []
+    if disc.discid:
+        lines.append(f"REM DISCID {disc.discid}")
+    lines.append(f"REM DATE {disc.year}")
+    lines.append(f"PERFORMER {quote(disc.artist)}")
+    lines.append(f"TITLE {quote(disc.album)}")
+
+    for i, t in enumerate(disc.tracks):
+        name = (files or {}).get(t.trackno, f"track{t.trackno}.wav")
+        ftype = "WAVE" if name.endswith(".wav") else EXT.upper()
+        lines.append(f"FILE {quote(name)} {ftype}")
+        lines.append(f"  TRACK {t.trackno:02} AUDIO")
+        lines.append(f"    TITLE {quote(t.title)}")
+        lines.append(f"    PERFORMER {quote(t.artist)}")
+
+        if offsets and i == 0 and offsets[0] > cdreader.LBA_OFFSET:
+            lines.append(f"    PREGAP {msf(offsets[0] - cdreader.LBA_OFFSET)}")
+        # Files start at the track's INDEX 01 offset.
+        lines.append(f"    INDEX 01 00:00:00")
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
@@ -0,0 +1,188 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import asyncio
+import json
+import os
+import shlex
+import struct
+import tempfile
+
+import cdinfo
+import detect
+import pipeline
+import util
+
+DEFAULT_PORT = 7439
+DEFAULT_HOST = "127.0.0.1"
+CONNECT_TIMEOUT = 5
+# How long to wait for the worker to make progress (send a message or a chunk of
+# data) before giving up on it, unless the pipeline has a timeout configured.
+IO_TIMEOUT = 300
+CHUNK_SIZE = 256 * 1024
+
+# Encode protocol: every message is a length-prefixed JSON header, optionally
+# followed by "size" bytes of raw file data.
+#
+# client -> worker: {"type": "encode", "trackno": N, "size": S} + WAV data
+# worker -> client: {"type": "output", "line": "..."} (any number of times)
+#                   {"type": "done", "size": S} + encoded data, or
+#                   {"type": "error", "message": "..."}
+
+
+async def send_message(writer, msg, path=None):
+    data = json.dumps(msg).encode("utf-8")
+    writer.write(struct.pack(">I", len(data)) + data)
+    if path:
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                writer.write(chunk)
+                await writer.drain()
+    await writer.drain()
+
+
+async def recv_message(reader):
+    (size,) = struct.unpack(">I", await reader.readexactly(4))
+    return json.loads(await reader.readexactly(size))
+
+
+async def recv_file(reader, path, size, timeout=None):
+    with open(path, "wb") as f:
+        while size:
+            chunk = await asyncio.wait_for(reader.read(min(size, CHUNK_SIZE)), timeout)
+            if not chunk:
+                raise Exception("connection closed while receiving data")
+            f.write(chunk)
+            size -= len(chunk)
+
+
+def parse_address(addr):
+    host, _, port = addr.rpartition(":")
+    if not host:
+        return addr, DEFAULT_PORT
+    return host, int(port)
+
+
+class RemoteEncoder:
+    """
+    Client side of a remote encode worker. Sends a ripped track to the worker and
+    receives the encoded file back. Fails if the worker doesn't make progress
+    within the timeout, so that the track can be encoded locally instead.
+    """
+
+    def __init__(self, addr, timeout=None):
+        self.name = addr
+        self.host, self.port = parse_address(addr)
+        self.timeout = timeout or IO_TIMEOUT
+        self.failed = False
+
+    async def encode(self, workdir, source, target, track, output):
+        try:
+            await self._encode(workdir, source, target, track, output)
+        except asyncio.TimeoutError:
+            raise Exception("worker timed out")
+
+    async def _encode(self, workdir, source, target, track, output):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), CONNECT_TIMEOUT
+        )
+
+        try:
+            path = os.path.join(workdir, source)
+            msg = {"type": "encode", "trackno": track.trackno}
+            msg["size"] = os.path.getsize(path)
+            await asyncio.wait_for(send_message(writer, msg, path), self.timeout)
+
+            while True:
+                msg = await asyncio.wait_for(recv_message(reader), self.timeout)
+                kind = msg.get("type")
+                if kind == "output":
+                    output(f"[{self.name}] {msg['line']}")
+                elif kind == "done":
+                    path = os.path.join(workdir, target)
+                    await recv_file(reader, path, msg["size"], self.timeout)
+                    return
+                elif kind == "error":
+                    raise Exception(msg["message"])
+                else:
+                    raise Exception(f"unexpected message from worker: {kind}")
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+
+class EncodeWorker:
+    """
+    Encode worker: receives ripped tracks over TCP, runs the local encoder on
+    them and sends the results back. Runs up to "jobs" encoders at a time.
+    """
+
+    def __init__(self, encoder, jobs=None, timeout=None):
+        self.encoder = encoder
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(jobs or os.cpu_count() or 1)
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    msg = await recv_message(reader)
+                except asyncio.IncompleteReadError:
+                    break
+
+                if msg.get("type") != "encode":
+                    await send_message(
+                        writer, {"type": "error", "message": "unknown request"}
+                    )
+                    break
+
+                with tempfile.TemporaryDirectory() as workdir:
+                    await self._encode(workdir, msg, reader, writer)
+        except Exception:
+            util.print_error()
+        finally:
+            writer.close()
+
+    async def _encode(self, workdir, msg, reader, writer):
+        source = "track.wav"
+        target = f"{source}.{pipeline.EXT}"
+        await recv_file(reader, os.path.join(workdir, source), msg["size"])
+
+        def output(line):
+            data = json.dumps({"type": "output", "line": line}).encode("utf-8")
+            writer.write(struct.pack(">I", len(data)) + data)
+
+        track = detect.TrackInfo(
+            artist="", album="", title="", trackno=int(msg["trackno"])
+        )
+        variables = cdinfo.cmd_fmt_variables(
+            track, workdir, source, target, pipeline.EXT
+        )
+        cmd = [arg.format(**variables) for arg in shlex.split(self.encoder)]
+
+        async with self.slots:
+            try:
+                await pipeline.run_command(cmd, output, self.timeout)
+            except Exception as e:
+                await send_message(writer, {"type": "error", "message": str(e)})
+                return
+
+        path = os.path.join(workdir, target)
+        msg = {"type": "done", "size": os.path.getsize(path)}
+        await send_message(writer, msg, path)
+
+
+def serve(addr, encoder, jobs=None):
+    """
+    Runs an encode worker. The protocol is not authenticated, so unless a host is
+    given, the worker only listens on the loopback interface.
+    """
+    if addr.isdigit():
+        host, port = DEFAULT_HOST, int(addr)
+    else:
+        host, port = parse_address(addr)
+    print(f"Encode worker listening on {host}:{port}")
+    asyncio.run(EncodeWorker(encoder, jobs).serve(host, port))
@@ -0,0 +1,65 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+
+import cdinfo
+import library
+import naming
+import ripper
+from PyQt5.QtWidgets import QDialog
+from PyQt5.QtWidgets import QMessageBox
+
+RETAG_EXTS = (".mp3", ".flac", ".ogg", ".opus")
+
+
+def retag_files(disc, paths, config, rename=True):
+    """
+    Rewrites the tags of already committed files with the disc's info. Tags are
+    updated in place when they fit in the existing padding. If "rename" is set,
+    files whose name no longer matches the template are moved within the target
+    directory. Returns the new paths.
+    """
+    # The paths are used as they are, so the tagger has no work directory.
+    tagger = ripper.Tagger(disc, config, "", retag=True)
+    template = None
+    if rename and config.target and config.template:
+        template = naming.compile_template(config.template)
+
+    ret = []
+    for track, path in zip(disc.tracks, paths):
+        tagger.tag(path, track)
+
+        if template:
+            ext = os.path.splitext(path)[1][1:]
+            dest = os.path.join(config.target, template.expand(disc, track, ext))
+            if dest != path and not os.path.exists(dest):
+                os.renames(path, dest)
+                path = dest
+        ret.append(path)
+
+    if config.cover_art == cdinfo.COVER_ART_SIDECAR and disc.cover_art and ret:
+        sidecar = os.path.join(os.path.dirname(ret[0]), ripper.SIDECAR_NAME)
+        with open(sidecar, "wb") as f:
+            f.write(disc.cover_art)
+
+    return ret
+
+
+def retag(app, path):
+    paths = next(library.find_albums(path, RETAG_EXTS), None)
+    if not paths:
+        QMessageBox.critical(None, "Error", f"No tagged files found in {path}.")
+        app.quit()
+        return
+
+    disc, paths = library.read_album(paths)
+    config = ripper.load_config()
+
+    info = cdinfo.InfoDialog(disc, config, paths)
+    if info.exec_() == QDialog.Rejected:
+        app.quit()
+        return
+    ripper.save_config(config)
+
+    retag_files(disc, paths, config)
+    QMessageBox.information(None, "fripper", f"Retagged {len(paths)} files.")
+    app.quit()
@@ -1,25 +1,51 @@
 # SPDX-License-Identifier: BSD-2-Clause
+import asyncio
+import base64
+import copy
 import os
-import shlex
 import shutil
-import subprocess
 import tempfile
-import threading
-import time
 from dataclasses import dataclass
 
+import boxset
 import cdinfo
+import mutagen
+import naming
+import pipeline
+import scheduling
+import telemetry
+import tocdb
+import tracing
 import util
 from PyQt5.QtCore import QThread
 from PyQt5.QtCore import Qt
 from PyQt5.QtCore import pyqtSignal
+from PyQt5.QtGui import QColor
+from PyQt5.QtGui import QPainter
 from PyQt5.QtWidgets import QDialog
 from PyQt5.QtWidgets import QMessageBox
+from PyQt5.QtWidgets import QWidget
 from mutagen import id3
+from mutagen.flac import FLAC
+from mutagen.flac import Picture
 from mutagen.mp3 import MP3
 
-CDPARANOIA_CMD = "cdparanoia --abort-on-skip --never-skip=10 {trackno} {output}"
-EXT = "mp3"
+SIDECAR_NAME = "folder.jpg"
+
+# Tag padding reserved in new files: enough for later edits of the text tags to
+# be written in place, without outweighing the size of a thumbnail cover.
+DEFAULT_PADDING = 8 * 1024
+
+MB_UFID_OWNER = "http://musicbrainz.org"
+
+# Maps the TXXX descriptions used by musicbrainz (Picard) to the equivalent
+# Vorbis comment names.
+VORBIS_MB_TAGS = {
+    "MusicBrainz Album Id": "musicbrainz_albumid",
+    "MusicBrainz Release Track Id": "musicbrainz_releasetrackid",
+    "MusicBrainz Disc Id": "musicbrainz_discid",
+    "MusicBrainz TOC": "musicbrainz_toc",
+}
 
 
 @dataclass
@@ -27,11 +53,22 @@ class Config:
     target: str = None
     encoder: str = None
     template: str = None
+    cover_art: str = cdinfo.COVER_ART_EMBED
+    thumb_size: int = 300
+    encoders: int = 1
+    timeout: float = None
+    whole_disc: bool = False
+    native_reader: bool = False
+    auto_speed: bool = False
+    workers: list = None
+    padding: int = DEFAULT_PADDING
+    scheduling: dict = None
+    reserve_reader_core: bool = False
+    verify: bool = False
+    verifiers: int = None
 
 
 class RipperDialog(util.compile_ui("ripper.ui")):
-    error = pyqtSignal(str)
-
     def __init__(self, disc, config, workdir):
         super().__init__()
         self.setWindowModality(Qt.ApplicationModal)
@@ -48,64 +85,66 @@ class RipperDialog(util.compile_ui("ripper.ui")):
 
         self.btnCancel.clicked.connect(self._cancel)
 
-        self.rip_thread = RipperThread(disc, config, workdir, self)
-        self.rip_thread.progress.connect(self._rip_progress)
-        self.rip_thread.finished.connect(self._child_done)
-        self.rip_thread.output.connect(lambda l: self._output(self.tbRipper, l))
+        self.pipeline = PipelineThread(disc, config, workdir)
+        self.pipeline.ripped.connect(self._rip_progress)
+        self.pipeline.encoded.connect(self._encode_progress)
+        self.pipeline.rip_output.connect(lambda l: self._output(self.tbRipper, l))
+        self.pipeline.encode_output.connect(lambda l: self._output(self.tbEncoder, l))
+        self.pipeline.error.connect(self._error)
+        self.pipeline.rip_stats.connect(self._rip_stats)
 
-        self.encoder_thread = EncodeThread(disc, config, workdir, self)
-        self.encoder_thread.progress.connect(self._encode_progress)
-        self.encoder_thread.finished.connect(self._child_done)
-        self.encoder_thread.output.connect(lambda l: self._output(self.tbEncoder, l))
-        self.rip_thread.progress.connect(self.encoder_thread.enqueue)
+        self.heatmap = HeatmapWidget(self)
+        self.verticalLayout_2.addWidget(self.heatmap)
+        self.stats = []
+        self.pipeline.finished.connect(self._pipeline_done)
 
         self._cancelled = False
-        self._done = 0
         self.errors = []
-        self.error.connect(self._error)
 
         self.rip_done = 0
         self.encode_done = 0
+        self._encoded = {}
 
-        self.rip_thread.start()
-        self.encoder_thread.start()
-
-        self.encoded = []
+        self.pipeline.start()
         util.restore_ui(self, "ripper")
 
+    @property
+    def encoded(self):
+        """
+        Encoded files, in track order.
+        """
+        return [self._encoded[k] for k in sorted(self._encoded)]
+
     def _completed(self, done, target):
         return f"{done}/{target}"
 
     def _cancel(self):
-        self.rip_thread.stop()
-        self.encoder_thread.stop()
         self._cancelled = True
+        self.pipeline.stop()
 
     def _set_progress(self, label, done):
         target = len(self.disc.tracks)
         label.setText(f"{done}/{target}")
 
-    def _rip_progress(self, fname):
+    def _rip_progress(self, trackno, fname):
         self.rip_done += 1
         self.pbRipper.setValue(self.rip_done)
         self._set_progress(self.lRipperCompleted, self.rip_done)
 
-    def _encode_progress(self, fname):
+    def _rip_stats(self, stats):
+        self.stats.append(stats)
+        self.heatmap.add(stats)
+
+    def _encode_progress(self, trackno, fname):
         self.encode_done += 1
         self.pbEncoder.setValue(self.encode_done)
         self._set_progress(self.lEncoderCompleted, self.encode_done)
-        self.encoded.append(fname)
+        self._encoded[trackno] = fname
 
     def _error(self, msg):
         self.errors.append(msg)
-        self.rip_thread.stop()
-        self.encoder_thread.stop()
-
-    def _child_done(self):
-        self._done += 1
-        if self._done != 2:
-            return
 
+    def _pipeline_done(self):
         util.save_ui(self, "ripper")
 
         if self._cancelled:
@@ -125,113 +164,172 @@ class RipperDialog(util.compile_ui("ripper.ui")):
         tbox.appendPlainText(line)
 
 
-class TaskThread(QThread):
-    progress = pyqtSignal(str)
-    output = pyqtSignal(str)
+class HeatmapWidget(QWidget):
+    """
+    Shows read problems (re-reads, corrections, errors, skips) along the disc,
+    one cell per second of audio, from green (clean) to red.
+    """
 
-    def __init__(self, disc, config, workdir, ripper):
-        QThread.__init__(self)
-        self.disc = disc
-        self.config = config
-        self.workdir = workdir
-        self.ripper = ripper
-        self.proc = None
-        self.active = True
+    HEAT_MAX = 10
 
-    def _exec(self, track, cmd, inf, outf):
-        variables = cdinfo.cmd_fmt_variables(track, self.workdir, inf, outf, EXT)
-        cmd = shlex.split(cmd)
-        for i in range(len(cmd)):
-            cmd[i] = cmd[i].format(**variables)
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.setMinimumHeight(24)
+        self.setMaximumHeight(24)
+        self.tracks = []
 
-        if util.TEST_MODE:
-            time.sleep(1)
+    def add(self, stats):
+        self.tracks.append(stats)
+        self.setToolTip(
+            "\n".join(f"Track {t.trackno}: {t.summary()}" for t in self.tracks)
+        )
+        self.update()
 
-        try:
-            self.proc = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding="utf-8"
-            )
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        width = self.width()
+        height = self.height()
+        painter.fillRect(0, 0, width, height, QColor(Qt.lightGray))
+
+        cells = sum(len(t.heat) for t in self.tracks)
+        if not cells:
+            return
 
-            for line in self.proc.stdout:
-                self.output.emit(line)
+        x = 0.0
+        step = width / cells
+        for t in self.tracks:
+            for heat in t.heat:
+                level = min(heat, self.HEAT_MAX) / self.HEAT_MAX
+                color = QColor(int(255 * level), int(200 * (1 - level)), 0)
+                painter.fillRect(int(x), 0, int(x + step) - int(x) + 1, height, color)
+                x += step
+            painter.setPen(Qt.black)
+            painter.drawLine(int(x), 0, int(x), height)
+
+
+class PipelineThread(QThread):
+    """
+    Qt adapter for the pipeline: runs its event loop in a thread and turns
+    pipeline events into signals.
+    """
+
+    rip_output = pyqtSignal(str)
+    ripped = pyqtSignal(int, str)
+    encode_output = pyqtSignal(str)
+    encoded = pyqtSignal(int, str)
+    rip_stats = pyqtSignal(object)
+    error = pyqtSignal(str)
 
-            ec = self.proc.wait()
-            if ec != 0:
-                raise Exception(f"process {cmd[0]} exited with {ec}")
+    def __init__(self, disc, config, workdir):
+        QThread.__init__(self)
+        self.pipeline = pipeline.Pipeline(
+            disc,
+            config,
+            workdir,
+            _SignalListener(self),
+            Tagger(disc, config, workdir),
+            encoders=config.encoders,
+            timeout=config.timeout,
+            workers=config.workers or (),
+        )
 
-            self.proc = None
-            return True
-        except Exception as e:
-            util.print_error()
-            if self.active:
-                self.ripper.error.emit(str(e))
-            return False
+    def run(self):
+        tracing.name_thread("pipeline")
+        with tracing.stage("pipeline"):
+            asyncio.run(self.pipeline.run())
 
     def stop(self):
-        self.active = False
-        if self.proc:
-            self.proc.terminate()
+        self.pipeline.cancel()
 
 
-class RipperThread(TaskThread):
-    def run(self):
-        for t in self.disc.tracks:
-            if not self.active:
-                break
-            target = f"track{t.trackno}.wav"
+class _SignalListener(pipeline.Listener):
+    def __init__(self, thread):
+        self.thread = thread
 
-            cmd = CDPARANOIA_CMD
-            if util.TEST_MODE:
-                cmd = "touch {output}"
+    def rip_output(self, line):
+        self.thread.rip_output.emit(line)
 
-            self.output.emit(f"==== Ripping track {t.trackno} - {t.title}")
-            if not self._exec(t, cmd, None, target):
-                break
-            self.output.emit(f"--- Done.")
-            self.progress.emit(target)
+    def ripped(self, track, fname):
+        self.thread.ripped.emit(track.trackno, fname)
 
+    def rip_stats(self, stats):
+        self.thread.rip_stats.emit(stats)
 
-class EncodeThread(TaskThread):
-    def __init__(self, disc, config, workdir, ripper):
-        super().__init__(disc, config, workdir, ripper)
-        self.queue = []
-        self.lock = threading.Lock()
-        self.event = threading.Event()
+    def encode_output(self, line):
+        self.thread.encode_output.emit(line)
 
-    def run(self):
-        done = 0
-        while done < len(self.disc.tracks):
-            self.event.wait()
+    def encoded(self, track, fname):
+        self.thread.encoded.emit(track.trackno, fname)
 
-            next = self.dequeue()
-            while next:
-                if not self.encode(next, self.disc.tracks[done]):
-                    return
-                done += 1
-                next = self.dequeue()
+    def error(self, msg):
+        self.thread.error.emit(msg)
 
-    def encode(self, source, track):
-        self.output.emit(f"==== Encoding track {track.trackno} - {track.title}")
 
-        target = f"{source}.{EXT}"
-        if not self._exec(track, self.config.encoder, source, target):
-            return False
+class Tagger:
+    """
+    Tags encoded files with the disc's information.
 
-        self.output.emit(f"--- Tagging...")
-        try:
-            self.tag(target, track)
-        except Exception as e:
-            util.print_error()
-            self.ripper.error.emit(f"error tagging {target}: {e}")
-            return False
+    New tags reserve config.padding bytes of padding, so that later edits can be
+    written in place. When retagging, existing padding is reused as long as the
+    new tag fits in it.
+    """
 
-        self.output.emit(f"--- Done.")
-        self.progress.emit(target)
-        return True
+    def __init__(self, disc, config, workdir, retag=False):
+        self.disc = disc
+        self.config = config
+        self.workdir = workdir
+        self.retag = retag
+
+        # Cover art frames are built once and shared by all tracks of the disc.
+        self.cover_art = None
+        self.apic = None
+        self.picture = None
+        self.picture_b64 = None
+        if disc.cover_art and config.cover_art != cdinfo.COVER_ART_SIDECAR:
+            self.cover_art = disc.cover_art
+            if config.cover_art == cdinfo.COVER_ART_THUMBNAIL:
+                self.cover_art = cdinfo.scale_image(disc.cover_art, config.thumb_size)
+
+            mime = cdinfo.image_mime(self.cover_art)
+            self.apic = id3.APIC(
+                encoding=id3.Encoding.UTF8,
+                mime=mime,
+                type=id3.PictureType.COVER_FRONT,
+                data=self.cover_art,
+            )
+            self.picture = Picture()
+            self.picture.type = id3.PictureType.COVER_FRONT
+            self.picture.mime = mime
+            self.picture.data = self.cover_art
+            self.picture_b64 = base64.b64encode(self.picture.write()).decode("ascii")
 
     def tag(self, target, track):
-        mp3 = MP3(os.path.join(self.workdir, target))
+        path = os.path.join(self.workdir, target)
+        f = mutagen.File(path)
+        if f is None:
+            raise Exception(f"unknown file format: {target}")
 
+        if isinstance(f, MP3):
+            self._tag_id3(f, track)
+        else:
+            self._tag_vorbis(f, track)
+
+        f.save(padding=self.padding)
+
+    def padding(self, info):
+        """
+        The padding callback for mutagen's save(), for files tagged by this tagger.
+        """
+        if not self.retag:
+            return self.config.padding
+        # Existing padding is kept if the new tags fit; otherwise mutagen's own
+        # heuristic is used rather than growing every retagged file by a fixed
+        # amount.
+        if info.padding >= 0:
+            return info.padding
+        return info.get_default_padding()
+
+    def _tag_id3(self, mp3, track):
         if not mp3.tags:
             mp3.add_tags()
 
@@ -247,29 +345,58 @@ class EncodeThread(TaskThread):
             tpos = f"{self.disc.discno}/{self.disc.set_size}"
         tags.add(id3.TPOS(encoding=id3.Encoding.UTF8, text=tpos))
 
-        if self.disc.cover_art:
-            tags.add(id3.APIC(encoding=id3.Encoding.UTF8, data=self.disc.cover_art))
+        for desc, value in musicbrainz_tags(self.disc, track).items():
+            tags.add(id3.TXXX(encoding=id3.Encoding.UTF8, desc=desc, text=value))
 
-        mp3.save()
+        if track.recording_id:
+            tags.add(
+                id3.UFID(owner=MB_UFID_OWNER, data=track.recording_id.encode("ascii"))
+            )
 
-    def dequeue(self):
-        next = None
-        with self.lock:
-            if self.queue:
-                next = self.queue[0]
-                del self.queue[0]
-            self.event.clear()
-        return next
+        if self.apic:
+            tags.add(self.apic)
 
-    def enqueue(self, next):
-        with self.lock:
-            self.queue.append(next)
-            self.event.set()
+    def _tag_vorbis(self, f, track):
+        if f.tags is None:
+            f.add_tags()
 
-    def stop(self):
-        with self.lock:
-            self.event.set()
-        super().stop()
+        tags = f.tags
+        tags["album"] = self.disc.album
+        tags["artist"] = self.disc.artist
+        tags["title"] = track.title
+        tags["tracknumber"] = str(track.trackno)
+        tags["date"] = str(self.disc.year)
+        tags["discnumber"] = str(self.disc.discno)
+        if self.disc.set_size > 1:
+            tags["disctotal"] = str(self.disc.set_size)
+
+        for desc, value in musicbrainz_tags(self.disc, track).items():
+            tags[VORBIS_MB_TAGS.get(desc, desc)] = value
+
+        if track.recording_id:
+            tags["musicbrainz_trackid"] = track.recording_id
+
+        if self.picture:
+            if isinstance(f, FLAC):
+                f.clear_pictures()
+                f.add_picture(self.picture)
+            else:
+                tags["metadata_block_picture"] = [self.picture_b64]
+
+
+def musicbrainz_tags(disc, track):
+    """
+    Returns the musicbrainz identifiers known for the track, keyed by their TXXX
+    description. Empty values are skipped.
+    """
+    tags = {
+        "MusicBrainz Album Id": disc.release_id,
+        "MusicBrainz Release Track Id": track.track_id,
+        "MusicBrainz Disc Id": disc.discid,
+        # Not "CDTOC", which by convention (EAC, foobar2000) holds a hex TOC.
+        "MusicBrainz TOC": disc.toc,
+    }
+    return {k: v for k, v in tags.items() if v}
 
 
 def commit_files(staging, target):
@@ -286,6 +413,9 @@ def commit_files(staging, target):
             commit_files(src, dst)
         else:
             if os.path.exists(dst):
+                if name == SIDECAR_NAME:
+                    # Written by a previous disc of the same set.
+                    continue
                 raise Exception(f"cannot write target {dst}: already exists")
             if util.TEST_MODE:
                 print(f"  {src} -> {dst}")
@@ -293,54 +423,141 @@ def commit_files(staging, target):
                 shutil.move(src, dst)
 
 
-def rename_files(disc, ripped, target, template):
+def rename_files(disc, ripped, target, template, sidecar=None, cue=False):
     if len(disc.tracks) != len(ripped):
         QMessageBox.critical(None, "Error", "Inconsistent state after ripping disc.")
         return
 
+    # Expand all names before moving anything, so that a bad name doesn't leave
+    # the staging directory half populated.
+    paths = naming.compile_template(template).plan(disc, pipeline.EXT)
+
+    files = {}
     for i in range(len(ripped)):
         t = disc.tracks[i]
         src = ripped[i]
 
-        variables = cdinfo.dest_fmt_variables(disc, t, EXT)
-
-        expanded = template.format(**variables)
         if util.TEST_MODE:
-            print(f"{src} -> {expanded}")
-        dest = os.path.join(target, expanded)
+            print(f"{src} -> {paths[i]}")
+        dest = os.path.join(target, paths[i])
 
         if i == 0:
             os.makedirs(os.path.dirname(dest))
+            if sidecar:
+                path = os.path.join(os.path.dirname(dest), SIDECAR_NAME)
+                with open(path, "wb") as f:
+                    f.write(sidecar)
         shutil.move(src, dest)
+        files[t.trackno] = dest
+
+    base = os.path.dirname(files[disc.tracks[0].trackno])
+    if cue:
+        # The cue sheet goes next to the first track, and refers to the final
+        # file names.
+        name = naming.cue_name(disc)
+        files = {k: os.path.relpath(v, base) for k, v in files.items()}
+        pipeline.write_cue(disc, os.path.join(base, name), files)
+
+    return base
+
+
+def remember_disc(disc):
+    """
+    Adds a ripped disc to the local TOC database, so that other pressings of the
+    same release can be resolved locally in the future.
+    """
+    try:
+        db = tocdb.TocDB()
+        try:
+            db.add(disc)
+        finally:
+            db.close()
+    except Exception:
+        util.print_error()
 
 
-def rip(app, disc):
-    config = Config(
+def load_config():
+    return Config(
         target=util.SETTINGS.value("fripper/target"),
         encoder=util.SETTINGS.value("fripper/encoder"),
         template=util.SETTINGS.value("fripper/template"),
+        cover_art=util.SETTINGS.value("fripper/cover_art", cdinfo.COVER_ART_EMBED),
+        thumb_size=int(util.SETTINGS.value("fripper/thumb_size", 300)),
+        encoders=int(util.SETTINGS.value("fripper/encoders", 1)),
+        timeout=float(util.SETTINGS.value("fripper/timeout", 0)) or None,
+        whole_disc=util.setting_bool("fripper/whole_disc"),
+        native_reader=util.setting_bool("fripper/native_reader"),
+        auto_speed=util.setting_bool("fripper/auto_speed"),
+        workers=util.setting_list("fripper/workers"),
+        padding=int(util.SETTINGS.value("fripper/padding", DEFAULT_PADDING)),
+        scheduling={
+            stage: util.SETTINGS.value(f"fripper/sched_{stage}", default)
+            for stage, default in scheduling.DEFAULT_POLICIES.items()
+        },
+        reserve_reader_core=util.setting_bool("fripper/reserve_reader_core"),
+        verify=util.setting_bool("fripper/verify"),
+        verifiers=int(util.SETTINGS.value("fripper/verifiers", 0)) or None,
     )
 
-    info = cdinfo.InfoDialog(disc, config)
-    if info.exec_() == QDialog.Rejected:
-        app.quit()
-        return
 
+def save_config(config):
     util.SETTINGS.setValue("fripper/target", config.target)
     util.SETTINGS.setValue("fripper/encoder", config.encoder)
     util.SETTINGS.setValue("fripper/template", config.template)
+    util.SETTINGS.setValue("fripper/cover_art", config.cover_art)
+    util.SETTINGS.setValue("fripper/thumb_size", config.thumb_size)
+    util.SETTINGS.setValue("fripper/whole_disc", config.whole_disc)
+    util.SETTINGS.setValue("fripper/native_reader", config.native_reader)
+    util.SETTINGS.setValue("fripper/auto_speed", config.auto_speed)
+    util.SETTINGS.setValue("fripper/verify", config.verify)
+
+
+def rip(app, disc):
+    config = load_config()
+
+    original = copy.deepcopy(disc)
+    info = cdinfo.InfoDialog(disc, config)
+    if info.exec_() == QDialog.Rejected:
+        app.quit()
+        return
+    edited = copy.deepcopy(disc)
+    save_config(config)
 
     with tempfile.TemporaryDirectory() as workdir:
         ripper = RipperDialog(disc, config, workdir)
-        ripper.exec_()
+        ripped = ripper.exec_() == QDialog.Accepted
 
         if info.rip_as_multi_disc:
-            disc.album = f"{disc.album} (Disc {disc.discno})"
-
-        encoded = [os.path.join(workdir, x) for x in ripper.encoded]
-        staging = tempfile.mkdtemp(dir=workdir)
-        rename_files(disc, encoded, staging, config.template)
-        commit_files(staging, config.target)
+            disc.album = cdinfo.multi_disc_album(disc)
+
+        with tracing.stage("commit"):
+            encoded = [os.path.join(workdir, x) for x in ripper.encoded]
+            staging = tempfile.mkdtemp(dir=workdir)
+            sidecar = None
+            if config.cover_art == cdinfo.COVER_ART_SIDECAR:
+                sidecar = disc.cover_art
+            album_dir = rename_files(
+                disc,
+                encoded,
+                staging,
+                config.template,
+                sidecar=sidecar,
+                cue=config.whole_disc and bool(disc.toc),
+            )
+            if album_dir and ripper.stats:
+                telemetry.save_stats(
+                    edited,
+                    ripper.stats,
+                    os.path.join(album_dir, naming.stats_name(disc)),
+                    scheduling=ripper.pipeline.pipeline.policies,
+                )
+            commit_files(staging, config.target)
+
+    # Only discs that were fully ripped and committed advance the TOC history
+    # and the box-set session.
+    if ripped and album_dir and not util.TEST_MODE:
+        remember_disc(edited)
+        boxset.update(original, edited)
 
     QMessageBox.information(None, "fripper", "Encoding done!")
     util.eject()
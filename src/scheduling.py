@@ -0,0 +1,116 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+import shutil
+from dataclasses import asdict
+from dataclasses import dataclass
+
+STAGES = ("rip", "encode", "verify")
+
+# Default policies: encoders yield CPU and disk to the reader and to other
+# services on the machine.
+DEFAULT_POLICIES = {
+    "rip": "",
+    "encode": "nice=10,ionice=2:7",
+    "verify": "nice=10,ionice=2:7",
+}
+
+
+def parse_cpus(spec):
+    """
+    Parses a CPU list like "0+2-3" into a sorted list of CPU numbers.
+    """
+    cpus = set()
+    for item in spec.split("+"):
+        if "-" in item:
+            lo, hi = item.split("-")
+            cpus.update(range(int(lo), int(hi) + 1))
+        elif item:
+            cpus.add(int(item))
+    return sorted(cpus)
+
+
+@dataclass
+class StagePolicy:
+    """
+    Scheduling policy applied to a stage's child processes when they're spawned:
+    niceness, I/O priority (class and level, as used by ionice) and CPU affinity.
+    """
+
+    nice: int = None
+    ionice_class: int = None
+    ionice_level: int = None
+    cpus: list = None
+
+    @staticmethod
+    def parse(spec):
+        """
+        Parses a policy like "nice=10,ionice=2:7,cpus=0+2-3".
+        """
+        policy = StagePolicy()
+        for item in (spec or "").split(","):
+            item = item.strip()
+            if not item:
+                continue
+            key, _, value = item.partition("=")
+            if key == "nice":
+                policy.nice = int(value)
+            elif key == "ionice":
+                cls, _, level = value.partition(":")
+                policy.ionice_class = int(cls)
+                policy.ionice_level = int(level) if level else None
+            elif key == "cpus":
+                policy.cpus = parse_cpus(value)
+            else:
+                raise ValueError(f"unknown scheduling option: {key}")
+        return policy
+
+    def command(self, cmd):
+        """
+        Returns the command to run, wrapped with taskset, nice and ionice as needed.
+        Each wrapper is skipped if the tool isn't available. Policies are applied
+        by the wrappers rather than in the forked child, since the fork happens in
+        a multithreaded process.
+        """
+        prefix = []
+        if self.cpus and shutil.which("taskset"):
+            prefix += ["taskset", "-c", ",".join(str(c) for c in self.cpus)]
+
+        if self.nice is not None and shutil.which("nice"):
+            # nice takes an increment; lowering niceness fails without privileges,
+            # in which case nice warns and runs the command anyway.
+            increment = self.nice - os.getpriority(os.PRIO_PROCESS, 0)
+            if increment:
+                prefix += ["nice", "-n", str(increment)]
+
+        if self.ionice_class is not None and shutil.which("ionice"):
+            prefix += ["ionice", "-c", str(self.ionice_class)]
+            if self.ionice_level is not None and self.ionice_class in (1, 2):
+                prefix += ["-n", str(self.ionice_level)]
+
+        return prefix + list(cmd) if prefix else cmd
+
+    def describe(self):
+        return {k: v for k, v in asdict(self).items() if v is not None}
+
+
+def policies(specs, reserve_reader_core=False):
+    """
+    Builds the policies for each stage from their specs. If reserve_reader_core
+    is set (and no affinity is configured), the reader is pinned to the last CPU
+    and the other stages to the remaining ones, so they can't starve the reader.
+    """
+    ret = {}
+    for stage in STAGES:
+        ret[stage] = StagePolicy.parse(specs.get(stage, DEFAULT_POLICIES[stage]))
+
+    available = []
+    if hasattr(os, "sched_getaffinity"):
+        available = sorted(os.sched_getaffinity(0))
+    if reserve_reader_core and len(available) > 1:
+        if not ret["rip"].cpus:
+            ret["rip"].cpus = available[-1:]
+        for stage in ("encode", "verify"):
+            if not ret[stage].cpus:
+                ret[stage].cpus = available[:-1]
+
+    return ret
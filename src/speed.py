@@ -0,0 +1,129 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import json
+import os
+
+import util
+
+PROFILE_NAME = "speeds.json"
+
+# Read speeds to choose from, fastest first. None means the drive's maximum.
+SPEEDS = [None, 40, 32, 24, 16, 8, 4]
+
+# Re-read rate (re-reads per read) above which a track is considered troubled,
+# and the drive is slowed down for the rest of the disc.
+SPIKE_RATE = 0.05
+
+# Minimum amount of data (in sectors) at a speed before its stats are trusted.
+MIN_SECTORS = 75 * 60 * 10
+
+# Recorded problems (read errors and skipped sectors) decay by this factor with
+# each disc, so that a speed ruled out by a damaged disc is tried again later.
+# Speeds are ruled out while at least one problem remains.
+PROBLEM_DECAY = 0.5
+
+
+def _key(speed):
+    return str(speed) if speed else "max"
+
+
+class SpeedStore:
+    """
+    Per-drive read speed profiles, learned from the stats of previous rips. Each
+    profile accumulates sectors, time, reads and problems per speed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or util.data_path(PROFILE_NAME)
+        self.profiles = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                self.profiles = json.load(f)
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.profiles, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def record(self, drive, speed, stats):
+        entry = self.profiles.setdefault(drive, {}).setdefault(
+            _key(speed),
+            {"sectors": 0, "elapsed": 0.0, "reads": 0, "rereads": 0, "problems": 0},
+        )
+        entry["sectors"] += stats.sectors
+        entry["elapsed"] += stats.elapsed
+        entry["reads"] += stats.reads
+        entry["rereads"] += stats.rereads
+        entry["problems"] += stats.read_errors + len(stats.skips)
+
+    def decay(self, drive):
+        for entry in self.profiles.get(drive, {}).values():
+            entry["problems"] *= PROBLEM_DECAY
+
+    def best_speed(self, drive):
+        """
+        Returns the speed with the best effective throughput among the ones with
+        enough data and no recent unrecoverable problems. Speeds faster than the best
+        known one that haven't been tried enough are preferred, so that the
+        profile keeps learning.
+        """
+        profile = self.profiles.get(drive, {})
+        found = False
+        best = None
+        best_rate = 0.0
+        for speed in SPEEDS:
+            entry = profile.get(_key(speed))
+            if not entry or entry["sectors"] < MIN_SECTORS:
+                if not found:
+                    return speed
+                continue
+
+            if entry["problems"] >= 1 or not entry["elapsed"]:
+                continue
+
+            rate = entry["sectors"] / entry["elapsed"]
+            if not found or rate > best_rate:
+                found = True
+                best = speed
+                best_rate = rate
+
+        return best if found else SPEEDS[-1]
+
+
+class SpeedController:
+    """
+    Chooses the read speed for a rip: starts from the drive's profile and steps
+    down when re-reads spike.
+    """
+
+    def __init__(self, store, drive):
+        self.store = store
+        self.drive = drive
+        self.current = store.best_speed(drive)
+        store.decay(drive)
+
+    def record(self, stats):
+        """
+        Records a track's stats at the current speed, without adapting it.
+        """
+        self.store.record(self.drive, self.current, stats)
+
+    def update(self, stats):
+        """
+        Records a track's stats at the current speed. Returns True if the speed
+        was lowered.
+        """
+        self.record(stats)
+
+        rate = stats.rereads / max(stats.reads, 1)
+        if rate <= SPIKE_RATE and not stats.skips:
+            return False
+
+        idx = SPEEDS.index(self.current) if self.current in SPEEDS else 0
+        if idx + 1 >= len(SPEEDS):
+            return False
+        self.current = SPEEDS[idx + 1]
+        return True
+
+    def describe(self):
+        return f"{self.current}x" if self.current else "max"
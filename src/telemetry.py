@@ -0,0 +1,204 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import dataclasses
+import json
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass
+from dataclasses import field
+
+import util
+
+STATS_LOG = "ripstats.jsonl"
+
+# Samples (16-bit words) per CD sector; cdparanoia reports positions in words.
+SECTOR_WORDS = 1176
+
+# Sectors per heatmap cell (one second of audio).
+HEAT_SECTORS = 75
+
+# Kinds of recorded events.
+READ = "read"
+REREAD = "reread"
+CORRECTION = "correction"
+READ_ERROR = "read error"
+SKIP = "skip"
+
+# Events reported by "cdparanoia -e", by the label it prints for them. Routine
+# events (verify, overlap, backoff, wrote, finished) are not recorded; reads are
+# handled separately.
+EVENTS = {
+    "jitter": CORRECTION,
+    "correction": CORRECTION,
+    "scratch repair": CORRECTION,
+    "dropped": CORRECTION,
+    "duped": CORRECTION,
+    "drift": CORRECTION,
+    "scratch": READ_ERROR,
+    "transport error": READ_ERROR,
+    "cache error": READ_ERROR,
+    "skip": SKIP,
+}
+
+# Reads overlap earlier ones by up to cdparanoia's maximum overlap (32 sectors),
+# so only reads ending further behind the furthest read so far are re-reads.
+REREAD_MARGIN = 64
+
+PROGRESS_RE = re.compile(r"^##: (-?\d+) \[([^\]]+)\] @ (-?\d+)")
+
+
+@dataclass
+class TrackStats:
+    trackno: int
+    sectors: int = 0
+    elapsed: float = 0.0
+    reads: int = 0
+    rereads: int = 0
+    corrections: int = 0
+    read_errors: int = 0
+    skips: list = field(default_factory=list)
+    heat: list = field(default_factory=list)
+
+    @property
+    def speed(self):
+        """
+        Effective read speed, as a multiple of real time.
+        """
+        if not self.elapsed:
+            return 0.0
+        return self.sectors / 75 / self.elapsed
+
+    def summary(self):
+        return (
+            f"{self.speed:.1f}x, {self.rereads} re-reads, "
+            f"{self.corrections} corrections, {len(self.skips)} skips"
+        )
+
+
+class ParanoiaLog:
+    """
+    Parses the output of "cdparanoia -e" into per-sector events. Positions are
+    sector numbers relative to the start of the disc (LSN).
+    """
+
+    def __init__(self):
+        self.events = []
+        self.max_read = -1
+        self.start = time.monotonic()
+
+    def feed(self, line):
+        """
+        Records the event in a progress line. Returns False if the line is not a
+        progress line.
+        """
+        m = PROGRESS_RE.match(line)
+        if not m:
+            return False
+
+        label = m.group(2)
+        sector = int(m.group(3)) // SECTOR_WORDS
+        if label == "read":
+            if sector < self.max_read - REREAD_MARGIN:
+                self.events.append((sector, REREAD))
+            else:
+                self.events.append((sector, READ))
+            self.max_read = max(self.max_read, sector)
+        elif label in EVENTS:
+            self.events.append((sector, EVENTS[label]))
+        return True
+
+    def stats(self, trackno, first=None, sectors=None, elapsed=None):
+        """
+        Returns the stats for the given sector range (or all events). The elapsed
+        time defaults to the time since the log was created.
+        """
+        if elapsed is None:
+            elapsed = time.monotonic() - self.start
+
+        events = self.events
+        if first is not None:
+            events = [e for e in events if first <= e[0] < first + sectors]
+        else:
+            first = min((e[0] for e in events), default=0)
+            sectors = max((e[0] for e in events), default=0) - first + 1
+
+        stats = TrackStats(trackno=trackno, sectors=sectors, elapsed=elapsed)
+        heat = Counter()
+        for sector, kind in events:
+            if kind == READ:
+                stats.reads += 1
+                continue
+
+            heat[(sector - first) // HEAT_SECTORS] += 1
+            if kind == REREAD:
+                stats.reads += 1
+                stats.rereads += 1
+            elif kind == CORRECTION:
+                stats.corrections += 1
+            elif kind == READ_ERROR:
+                stats.read_errors += 1
+            elif kind == SKIP:
+                stats.skips.append(sector)
+
+        cells = (sectors + HEAT_SECTORS - 1) // HEAT_SECTORS
+        stats.heat = [heat[i] for i in range(cells)]
+        return stats
+
+
+def from_read_stats(trackno, read_stats):
+    """
+    Converts the stats of the native reader into TrackStats.
+    """
+    return TrackStats(
+        trackno=trackno,
+        sectors=read_stats.sectors,
+        elapsed=read_stats.elapsed,
+        reads=read_stats.sectors,
+        rereads=read_stats.retries,
+        read_errors=len(read_stats.bad_sectors),
+        skips=list(read_stats.bad_sectors),
+    )
+
+
+def drive_id():
+    """
+    Returns a "vendor model revision" string for the default drive.
+    """
+    if util.TEST_MODE:
+        return "test drive"
+
+    import cdio
+    import pycdio
+
+    try:
+        d = cdio.Device(driver_id=pycdio.DRIVER_UNKNOWN)
+        return " ".join(x.strip() for x in d.get_hwinfo() if x).strip()
+    except Exception:
+        util.print_error()
+        return "unknown"
+
+
+def stats_json(disc, stats, drive=None, scheduling=None):
+    return {
+        "time": int(time.time()),
+        "drive": drive or drive_id(),
+        "discid": disc.discid,
+        "release_id": disc.release_id,
+        "discno": disc.discno,
+        "scheduling": {k: v.describe() for k, v in (scheduling or {}).items()},
+        "tracks": [dataclasses.asdict(s) for s in stats],
+    }
+
+
+def save_stats(disc, stats, path, scheduling=None):
+    """
+    Writes the rip's stats next to the ripped files, and appends them to the
+    station's log. scheduling maps stages to the policies they ran with.
+    """
+    data = stats_json(disc, stats, scheduling=scheduling)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=1)
+
+    if not util.TEST_MODE:
+        with open(util.data_path(STATS_LOG), "a", encoding="utf-8") as f:
+            f.write(json.dumps(data) + "\n")
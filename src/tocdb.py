@@ -0,0 +1,236 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import dataclasses
+import datetime
+import json
+import sqlite3
+
+import detect
+import metadata
+import util
+
+DB_NAME = "tocs.db"
+
+# Maximum difference, in sectors (1/75s), allowed between each track offset of two
+# TOCs for them to be considered the same disc.
+TOLERANCE = 150
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tocs (
+    discid TEXT NOT NULL,
+    release_id TEXT NOT NULL,
+    tracks INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    toc TEXT NOT NULL,
+    info TEXT NOT NULL,
+    cover_art BLOB,
+    PRIMARY KEY (discid, release_id)
+);
+CREATE INDEX IF NOT EXISTS tocs_shape ON tocs (tracks, length);
+"""
+
+
+def parse_toc(toc):
+    """
+    Parses a musicbrainz-style TOC string into a (offsets, leadout) tuple.
+    """
+    values = [int(x) for x in toc.split()]
+    if len(values) < 4:
+        raise ValueError(f"invalid TOC: {toc}")
+    return values[3:], values[2]
+
+
+def distance(a, b):
+    """
+    Distance between two TOCs given as (offsets, leadout) tuples. Offsets are
+    compared relative to the first track, so that a constant shift (different
+    pregap) doesn't count. Returns None if the TOCs have different track counts.
+    """
+    offs_a, leadout_a = a
+    offs_b, leadout_b = b
+    if len(offs_a) != len(offs_b):
+        return None
+
+    va = [x - offs_a[0] for x in offs_a[1:] + [leadout_a]]
+    vb = [x - offs_b[0] for x in offs_b[1:] + [leadout_b]]
+    return max((abs(x - y) for x, y in zip(va, vb)), default=0)
+
+
+def _to_json(disc):
+    data = dataclasses.asdict(disc)
+    del data["cover_art"]
+    return json.dumps(data)
+
+
+def _from_json(data, cover_art):
+    data = json.loads(data)
+    data["tracks"] = [detect.TrackInfo(**t) for t in data["tracks"]]
+    data["cover_art"] = cover_art
+    return detect.CDInfo(**data)
+
+
+class TocDB:
+    """
+    Local index of disc TOCs, used to resolve discs that musicbrainz doesn't know
+    about by finding a release with a nearly identical TOC (e.g. a different
+    pressing with a slightly different leadout).
+    """
+
+    def __init__(self, path=None):
+        self.path = path or util.data_path(DB_NAME)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def add(self, disc, commit=True):
+        """
+        Adds a disc to the index. Discs without a TOC are ignored.
+        """
+        if not disc.toc:
+            return False
+
+        offsets, leadout = parse_toc(disc.toc)
+        self.db.execute(
+            "INSERT OR REPLACE INTO tocs VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                disc.discid,
+                disc.release_id or "",
+                len(offsets),
+                leadout - offsets[0],
+                disc.toc,
+                _to_json(disc),
+                disc.cover_art,
+            ),
+        )
+        if commit:
+            self.db.commit()
+        return True
+
+    def lookup(self, toc, tolerance=TOLERANCE):
+        """
+        Returns the known releases whose TOC is within the given tolerance of the
+        given TOC string, closest first. The returned CDInfo instances have their
+        TOC replaced with the queried one.
+        """
+        offsets, leadout = parse_toc(toc)
+        length = leadout - offsets[0]
+
+        rows = self.db.execute(
+            "SELECT discid, toc, info, cover_art FROM tocs "
+            "WHERE tracks = ? AND length BETWEEN ? AND ?",
+            (len(offsets), length - tolerance, length + tolerance),
+        )
+
+        matches = []
+        for discid, other, info, cover_art in rows:
+            dist = distance((offsets, leadout), parse_toc(other))
+            if dist is None or dist > tolerance:
+                continue
+
+            disc = _from_json(info, cover_art)
+            matches.append((dist, disc))
+
+        matches.sort(key=lambda m: m[0])
+        ret = []
+        for _, disc in matches:
+            if any(r.release_id and r.release_id == disc.release_id for r in ret):
+                continue
+            disc.toc = toc
+            ret.append(disc)
+        return ret
+
+    def import_dump(self, path):
+        """
+        Imports releases from a musicbrainz JSON dump (one release per line; may be
+        gzip or xz compressed). Returns the number of discs added. Malformed lines
+        are skipped and counted; if no line can be parsed, the file is assumed not
+        to be a dump and an exception is raised.
+        """
+        count = parsed = bad = 0
+        with metadata.open_dump(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    discs = list(discs_from_json(json.loads(line)))
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    bad += 1
+                    continue
+
+                parsed += 1
+                for disc in discs:
+                    if self.add(disc, commit=False):
+                        count += 1
+
+        if bad and not parsed:
+            raise Exception(f"{path} is not a musicbrainz JSON dump")
+        if bad:
+            print(f"Skipped {bad} malformed lines in {path}.")
+
+        self.db.commit()
+        return count
+
+
+def discs_from_json(rel):
+    """
+    Yields a CDInfo for each disc ID attached to a release in the musicbrainz JSON
+    format (as used by the web service and the JSON data dumps).
+    """
+    year = 1900
+    date = rel.get("date") or ""
+    try:
+        year = datetime.datetime.strptime(date[:4], "%Y").year
+    except ValueError:
+        pass
+
+    media = rel.get("media", [])
+    for medium in media:
+        discs = medium.get("discs", [])
+        if not discs:
+            continue
+
+        album = medium.get("title") or rel.get("title")
+        tracks = []
+        found_artists = set()
+        for t in medium.get("tracks", []):
+            artists = t.get("artist-credit") or rel.get("artist-credit", [])
+            if len(artists) == 1:
+                artist = artists[0]["artist"]["name"]
+                found_artists.add(artist)
+            else:
+                artist = "Various"
+
+            recording = t.get("recording", {})
+            tracks.append(
+                detect.TrackInfo(
+                    artist=artist,
+                    album=album,
+                    title=t.get("title") or recording.get("title"),
+                    trackno=int(t["position"]),
+                    recording_id=recording.get("id", ""),
+                    track_id=t.get("id", ""),
+                )
+            )
+
+        album_artist = "Various"
+        if len(found_artists) == 1:
+            album_artist = list(found_artists)[0]
+
+        for d in discs:
+            toc = [1, len(d["offsets"]), d["sectors"]] + d["offsets"]
+            yield detect.CDInfo(
+                artist=album_artist,
+                album=album,
+                tracks=sorted(tracks, key=lambda t: t.trackno),
+                discno=int(medium["position"]),
+                year=year,
+                set_size=len(media),
+                multi_artist=len(found_artists) > 1,
+                cover_art=None,
+                disambiguation=rel.get("disambiguation", ""),
+                discid=d["id"],
+                release_id=rel["id"],
+                toc=" ".join(str(x) for x in toc),
+            )
@@ -0,0 +1,239 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import atexit
+import cProfile
+import contextlib
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+
+from PyQt5.QtCore import QTimer
+
+# Default threshold for reporting stalls of the UI event loop.
+STALL_THRESHOLD_MS = 100
+
+_tracer = None
+
+
+class Tracer:
+    """
+    Records events in the Chrome trace format, which can be loaded in Perfetto
+    (ui.perfetto.dev) or chrome://tracing. Timestamps are in microseconds since
+    the tracer was created.
+    """
+
+    def __init__(self, path, stages=False):
+        self.path = path
+        self.stages = stages
+        self.start = time.perf_counter_ns()
+        self.pid = os.getpid()
+        self.events = []
+        self.threads = set()
+        self.ids = itertools.count(1)
+        self.profiles = {}
+        self.lock = threading.Lock()
+
+    def now(self):
+        return (time.perf_counter_ns() - self.start) // 1000
+
+    def add(self, event, tid=None):
+        if tid is None:
+            tid = threading.get_native_id()
+            if tid not in self.threads:
+                self.thread_name(tid, threading.current_thread().name)
+        event["pid"] = self.pid
+        event["tid"] = tid
+        with self.lock:
+            self.events.append(event)
+
+    def thread_name(self, tid, name):
+        self.threads.add(tid)
+        self.add({"ph": "M", "name": "thread_name", "args": {"name": name}}, tid)
+
+    def profile_path(self, stage):
+        """
+        Returns the path of the next cProfile dump for the stage, next to the trace.
+        """
+        with self.lock:
+            n = self.profiles[stage] = self.profiles.get(stage, 0) + 1
+        base = os.path.splitext(self.path)[0]
+        suffix = f"-{n}" if n > 1 else ""
+        return f"{base}-{stage}{suffix}.prof"
+
+    def save(self):
+        with self.lock:
+            data = {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+
+
+def enable(path, stages=False):
+    """
+    Starts recording a trace to the given path; if stages is set, also writes a
+    cProfile dump for each stage. The trace is written when the process exits.
+    """
+    global _tracer
+    _tracer = Tracer(path, stages)
+    _tracer.thread_name(threading.get_native_id(), "main")
+    atexit.register(save)
+
+
+def enabled():
+    return _tracer is not None
+
+
+def save():
+    if _tracer:
+        _tracer.save()
+
+
+def name_thread(name):
+    """
+    Names the current thread in the trace.
+    """
+    if _tracer:
+        _tracer.thread_name(threading.get_native_id(), name)
+
+
+@contextlib.contextmanager
+def span(name, cat="app", **args):
+    """
+    Records a span on the current thread's timeline.
+    """
+    if not _tracer:
+        yield
+        return
+
+    start = _tracer.now()
+    try:
+        yield
+    finally:
+        event = {"ph": "X", "name": name, "cat": cat, "ts": start}
+        event["dur"] = _tracer.now() - start
+        if args:
+            event["args"] = args
+        _tracer.add(event)
+
+
+@contextlib.contextmanager
+def task_span(name, cat="task", **args):
+    """
+    Records a span for work that interleaves with other work on the same thread,
+    like asyncio tasks. These are shown as async tracks, grouped by category.
+    """
+    if not _tracer:
+        yield
+        return
+
+    event = {"name": name, "cat": cat, "id": next(_tracer.ids)}
+    _tracer.add(dict(event, ph="b", ts=_tracer.now(), args=args))
+    try:
+        yield
+    finally:
+        _tracer.add(dict(event, ph="e", ts=_tracer.now()))
+
+
+def process(pid, cmd, start, ec=None):
+    """
+    Records the lifetime of a child process, on a timeline of its own. "start" is
+    the value of now() when it was spawned.
+    """
+    if not _tracer:
+        return
+
+    _tracer.thread_name(pid, f"{os.path.basename(cmd[0])} ({pid})")
+    event = {"ph": "X", "name": os.path.basename(cmd[0]), "cat": "process"}
+    event["ts"] = start
+    event["dur"] = _tracer.now() - start
+    event["args"] = {"cmd": " ".join(cmd), "exit": ec}
+    _tracer.add(event, pid)
+
+
+def now():
+    return _tracer.now() if _tracer else 0
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Records a span for a stage of the rip and, if enabled, a cProfile dump of the
+    current thread while it runs.
+    """
+    if not _tracer or not _tracer.stages:
+        with span(name, cat="stage"):
+            yield
+        return
+
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+    except ValueError:
+        # Only one profiler can be active at a time in recent Python versions.
+        print(f"Not profiling stage {name}: another profiler is active.")
+        prof = None
+
+    try:
+        with span(name, cat="stage"):
+            yield
+    finally:
+        if prof:
+            prof.disable()
+            prof.dump_stats(_tracer.profile_path(name))
+
+
+class StallWatchdog(threading.Thread):
+    """
+    Watches the latency of the Qt event loop. A timer on the main thread records a
+    heartbeat; if the heartbeat is late by more than the threshold, the stack of
+    the main thread is sampled and logged, and the stall is added to the trace.
+    """
+
+    def __init__(self, threshold_ms=STALL_THRESHOLD_MS):
+        super().__init__(name="stall-watchdog", daemon=True)
+        self.threshold = threshold_ms / 1000
+        self.interval = self.threshold / 4
+        self.main = threading.main_thread().ident
+        self.beat = time.monotonic()
+        self.stall = None
+
+        self.timer = QTimer()
+        self.timer.setInterval(max(1, int(self.interval * 1000)))
+        self.timer.timeout.connect(self._beat)
+
+    def start(self):
+        self.timer.start()
+        super().start()
+
+    def _beat(self):
+        now = time.monotonic()
+        self.beat = now
+        stall, self.stall = self.stall, None
+        if stall:
+            duration = now - stall["since"]
+            print(f"UI stall ended after {duration * 1000:.0f} ms.", file=sys.stderr)
+            if _tracer:
+                event = {"ph": "X", "name": "ui stall", "cat": "stall"}
+                event["ts"] = stall["ts"]
+                event["dur"] = int(duration * 1000000)
+                event["args"] = {"stack": stall["stack"]}
+                _tracer.add(event)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            since = self.beat
+            late = time.monotonic() - since
+            if late < self.threshold or self.stall:
+                continue
+
+            frame = sys._current_frames().get(self.main)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            ts = now() - int(late * 1000000)
+            self.stall = {"since": since, "ts": ts, "stack": stack}
+            print(
+                f"UI stalled for {late * 1000:.0f} ms, main thread at:\n{stack}",
+                file=sys.stderr,
+            )
@@ -0,0 +1,254 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import argparse
+import hashlib
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+
+import cdinfo
+import library
+import mutagen
+import naming
+import pipeline
+import ripper
+import util
+from mutagen import id3
+from mutagen.mp3 import MP3
+
+SOURCE_EXTS = (".flac",)
+DECODE_CMD = "flac --silent --decode --force --output-name {output} {input}"
+
+# Tag holding the hash of the source file an output was transcoded from.
+SOURCE_HASH_TAG = "fripper source hash"
+
+# Output extensions of common encoders, used when no extension is given.
+ENCODER_EXTS = {"lame": "mp3", "oggenc": "ogg", "opusenc": "opus", "flac": "flac"}
+
+CHECK_MTIME = "mtime"
+CHECK_HASH = "hash"
+
+
+def _first(tags, name, default=""):
+    value = tags.get(name)
+    return value[0] if value else default
+
+
+def file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _stored_hash(path):
+    try:
+        f = mutagen.File(path)
+    except Exception:
+        return None
+    if f is None or f.tags is None:
+        return None
+
+    if isinstance(f, MP3):
+        frame = f.tags.get(f"TXXX:{SOURCE_HASH_TAG}")
+        return frame.text[0] if frame else None
+    return _first(f.tags, SOURCE_HASH_TAG) or None
+
+
+def _store_hash(path, digest, padding):
+    f = mutagen.File(path)
+    if isinstance(f, MP3):
+        frame = id3.TXXX(encoding=id3.Encoding.UTF8, desc=SOURCE_HASH_TAG, text=digest)
+        f.tags.add(frame)
+    else:
+        f.tags[SOURCE_HASH_TAG] = digest
+    f.save(padding=padding)
+
+
+def encoder_ext(encoder):
+    """
+    Guesses the extension of an encoder command's output, or returns None.
+    """
+    args = shlex.split(encoder)
+    return ENCODER_EXTS.get(os.path.basename(args[0])) if args else None
+
+
+def up_to_date(source, dest, check):
+    if not os.path.exists(dest):
+        return False
+    if check == CHECK_HASH:
+        return _stored_hash(dest) == file_hash(source)
+    return os.path.getmtime(dest) >= os.path.getmtime(source)
+
+
+def _run(cmd, variables):
+    cmd = [arg.format(**variables) for arg in shlex.split(cmd)]
+    res = subprocess.run(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding="utf-8"
+    )
+    if res.returncode != 0:
+        raise Exception(f"{cmd[0]} exited with {res.returncode}: {res.stdout}")
+
+
+def transcode_track(disc, track, source, dest, config, check, ext):
+    """
+    Transcodes one track; runs in a worker process. Returns False if the
+    destination was already up to date.
+    """
+    if up_to_date(source, dest, check):
+        return False
+
+    with tempfile.TemporaryDirectory() as workdir:
+        wav = "track.wav"
+        target = f"{wav}.{ext}"
+
+        # "source" is absolute, so it's not resolved against the work directory.
+        variables = cdinfo.cmd_fmt_variables(track, workdir, source, wav, ext)
+        _run(DECODE_CMD, variables)
+
+        variables = cdinfo.cmd_fmt_variables(track, workdir, wav, target, ext)
+        _run(config.encoder, variables)
+
+        tagger = ripper.Tagger(disc, config, workdir)
+        tagger.tag(target, track)
+        if check == CHECK_HASH:
+            path = os.path.join(workdir, target)
+            _store_hash(path, file_hash(source), tagger.padding)
+
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.move(os.path.join(workdir, target), dest)
+
+    return True
+
+
+def transcode(source, config, jobs=None, check=CHECK_MTIME, ext=pipeline.EXT):
+    """
+    Transcodes a library of lossless files into the configured target directory,
+    naming the outputs with the configured template and the encoder's file
+    extension. Returns the number of (transcoded, skipped, failed) tracks.
+    """
+    template = naming.compile_template(config.template)
+    done = skipped = failed = 0
+
+    # Only a few tracks per worker are queued at a time, so that results are
+    # reported as they complete and large libraries aren't held in memory.
+    window = 2 * (jobs or os.cpu_count() or 1)
+    futures = {}
+
+    def drain(limit):
+        nonlocal done, skipped, failed
+        while len(futures) > limit:
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for f in finished:
+                path, dest = futures.pop(f)
+                try:
+                    if f.result():
+                        done += 1
+                        print(f"{path} -> {dest}")
+                    else:
+                        skipped += 1
+                except Exception as e:
+                    failed += 1
+                    print(f"Error transcoding {path}: {e}")
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for paths in library.find_albums(source, SOURCE_EXTS):
+            try:
+                disc, paths = library.read_album(paths)
+            except Exception as e:
+                print(f"Error reading {os.path.dirname(paths[0])}: {e}")
+                failed += len(paths)
+                continue
+
+            # Existing outputs are expected here (they're skipped if up to date),
+            # so only names within the album are checked.
+            try:
+                dests = template.plan(disc, ext)
+            except Exception as e:
+                print(f"Error naming {os.path.dirname(paths[0])}: {e}")
+                failed += len(paths)
+                continue
+            dests = [os.path.join(config.target, d) for d in dests]
+
+            for track, path, dest in zip(disc.tracks, paths, dests):
+                drain(window - 1)
+                args = (disc, track, path, dest, config, check, ext)
+                f = pool.submit(transcode_track, *args)
+                futures[f] = (path, dest)
+
+            if config.cover_art == cdinfo.COVER_ART_SIDECAR and disc.cover_art:
+                album_dir = os.path.dirname(dests[0])
+                sidecar = os.path.join(album_dir, ripper.SIDECAR_NAME)
+                if not os.path.exists(sidecar):
+                    os.makedirs(album_dir, exist_ok=True)
+                    with open(sidecar, "wb") as f:
+                        f.write(disc.cover_art)
+
+        drain(0)
+
+    return done, skipped, failed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="fripper transcode",
+        description="transcode a lossless library using the fripper settings",
+    )
+    parser.add_argument("source", metavar="SOURCE", help="source library directory")
+    parser.add_argument(
+        "--target",
+        "-t",
+        default=util.SETTINGS.value("fripper/target"),
+        help="target directory (default: saved target)",
+    )
+    parser.add_argument(
+        "--encoder",
+        "-e",
+        default=util.SETTINGS.value("fripper/encoder"),
+        help="encoder command (default: saved encoder)",
+    )
+    parser.add_argument(
+        "--template",
+        default=util.SETTINGS.value("fripper/template"),
+        help="file name template (default: saved template)",
+    )
+    parser.add_argument(
+        "--ext",
+        help="extension of the encoder's output (default: guessed from the encoder)",
+    )
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=None, help="number of parallel encoders"
+    )
+    parser.add_argument(
+        "--check",
+        choices=[CHECK_MTIME, CHECK_HASH],
+        default=CHECK_MTIME,
+        help="how to detect outputs that are up to date",
+    )
+    args = parser.parse_args(argv)
+
+    for name in ("target", "encoder", "template"):
+        if not getattr(args, name):
+            parser.error(f"no {name} given and none saved")
+
+    config = ripper.load_config()
+    config.target = args.target
+    config.encoder = args.encoder
+    config.template = args.template
+    try:
+        naming.compile_template(config.template)
+    except Exception as e:
+        parser.error(str(e))
+
+    ext = args.ext or encoder_ext(config.encoder)
+    if not ext:
+        parser.error("can't guess the encoder's file extension; use --ext")
+
+    done, skipped, failed = transcode(args.source, config, args.jobs, args.check, ext)
+    print(f"{done} transcoded, {skipped} up to date, {failed} failed.")
+    return 1 if failed else 0
@@ -4,6 +4,7 @@ import os
 import cdio
 import pycdio
 import requests
+import tracing
 from PyQt5 import uic
 from PyQt5.QtCore import QSettings
 from PyQt5.QtWidgets import QApplication
@@ -12,10 +13,33 @@ SETTINGS = QSettings("vanzin.org", "fripper")
 TEST_MODE = False
 
 
+def setting_bool(name, default=False):
+    value = SETTINGS.value(name, default)
+    if isinstance(value, str):
+        return value.lower() == "true"
+    return bool(value)
+
+
+def setting_list(name):
+    value = SETTINGS.value(name)
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [v.strip() for v in value if v.strip()]
+
+
 def icon(name):
     return os.path.join(os.path.dirname(__file__), "icons", name)
 
 
+def data_path(name):
+    base = os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share")
+    path = os.path.join(base, "fripper")
+    os.makedirs(path, exist_ok=True)
+    return os.path.join(path, name)
+
+
 def compile_ui(src):
     path = os.path.join(os.path.dirname(__file__), "ui", src)
     form, qtclass = uic.loadUiType(path)
@@ -56,9 +80,10 @@ def print_error():
 
 
 def http_get(url):
-    res = requests.get(url)
-    res.raise_for_status()
-    return res.content
+    with tracing.span("GET", cat="net", url=url):
+        res = requests.get(url)
+        res.raise_for_status()
+        return res.content
 
 
 def eject():
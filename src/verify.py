@@ -0,0 +1,91 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import hashlib
+import wave
+
+import mutagen
+
+# Commands to decode encoded files back to WAV, by format.
+DECODE_CMDS = {
+    "mp3": "lame --quiet --decode {input} {output}",
+    "flac": "flac --silent --decode --force --output-name {output} {input}",
+    "ogg": "oggdec --quiet --output {output} {input}",
+    "opus": "opusdec --quiet --rate 44100 {input} {output}",
+}
+
+# mutagen file types, by format.
+FORMATS = {"MP3": "mp3", "FLAC": "flac", "OggVorbis": "ogg", "OggOpus": "opus"}
+
+# Formats whose decoded audio must be identical to the source.
+LOSSLESS = {"flac"}
+
+# How much lossy formats may differ from the source, in samples and seconds.
+# Encoder delay and padding add up to a couple of MP3 frames.
+SAMPLE_TOLERANCE = 3 * 1152
+DURATION_TOLERANCE = 0.1
+
+READ_FRAMES = 44100
+
+
+def file_format(path):
+    """
+    Returns the format of an encoded file, as a key in DECODE_CMDS, or None if it
+    can't be verified.
+    """
+    f = mutagen.File(path)
+    return FORMATS.get(type(f).__name__) if f is not None else None
+
+
+def pcm_info(path, checksum=False):
+    """
+    Returns the (sample count, sample rate, channels, MD5 of the samples) of a WAV
+    file. The checksum is None unless requested.
+    """
+    with wave.open(path, "rb") as w:
+        frames = w.getnframes()
+        md5 = None
+        if checksum:
+            # The header's length can't be trusted from decoders writing to pipes,
+            # so the samples are counted while hashing.
+            md5 = hashlib.md5()
+            frames = 0
+            while True:
+                data = w.readframes(READ_FRAMES)
+                if not data:
+                    break
+                md5.update(data)
+                frames += len(data) // (w.getsampwidth() * w.getnchannels())
+            md5 = md5.hexdigest()
+        return frames, w.getframerate(), w.getnchannels(), md5
+
+
+def compare(source, decoded, encoded, fmt):
+    """
+    Checks a decoded file against the source it was encoded from, raising an
+    exception describing the mismatch. Returns a short summary otherwise.
+    """
+    lossless = fmt in LOSSLESS
+    src_frames, src_rate, src_channels, src_md5 = pcm_info(source, lossless)
+    frames, rate, channels, md5 = pcm_info(decoded, lossless)
+
+    if (rate, channels) != (src_rate, src_channels):
+        raise Exception(
+            f"format mismatch: {rate} Hz/{channels} ch, "
+            f"source is {src_rate} Hz/{src_channels} ch"
+        )
+
+    tolerance = 0 if lossless else SAMPLE_TOLERANCE
+    if abs(frames - src_frames) > tolerance:
+        raise Exception(f"decoded {frames} samples, source has {src_frames}")
+
+    length = mutagen.File(encoded).info.length
+    src_length = src_frames / src_rate
+    if abs(length - src_length) > DURATION_TOLERANCE + tolerance / src_rate:
+        raise Exception(f"duration is {length:.2f}s, source is {src_length:.2f}s")
+
+    if lossless and md5 != src_md5:
+        raise Exception("decoded audio differs from the source")
+
+    summary = f"{frames} samples"
+    if lossless:
+        summary += f", md5 {md5}"
+    return summary
@@ -0,0 +1,5 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
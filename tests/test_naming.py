@@ -0,0 +1,110 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+
+import detect
+import naming
+import pytest
+
+TEMPLATE = "{artist}/{album}/<{discno}->{trackno} {track}.{ext}"
+
+
+def make_disc(titles, set_size=1):
+    tracks = [
+        detect.TrackInfo(artist="Artist", album="Album", title=t, trackno=i + 1)
+        for i, t in enumerate(titles)
+    ]
+    return detect.CDInfo(
+        artist="Artist",
+        album="Album",
+        tracks=tracks,
+        discno=1,
+        year=2000,
+        set_size=set_size,
+        multi_artist=False,
+        cover_art=None,
+    )
+
+
+def create(target, paths):
+    for path in paths:
+        full = os.path.join(target, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        open(full, "wb").close()
+    return [os.path.join(target, p) for p in paths]
+
+
+def test_expand():
+    template = naming.compile_template(TEMPLATE)
+    disc = make_disc(["One", "Two"])
+    assert template.expand(disc, disc.tracks[0], "mp3") == "Artist/Album/1 One.mp3"
+
+    disc.set_size = 2
+    assert template.expand(disc, disc.tracks[1], "mp3") == "Artist/Album/1-2 Two.mp3"
+
+
+def test_expand_indexing():
+    # Fields can be indexed like in str.format(), e.g. to group by initial.
+    template = naming.compile_template("{artist[0]}/{artist}/{trackno} {track}.{ext}")
+    disc = make_disc(["One"])
+    assert template.expand(disc, disc.tracks[0], "mp3") == "A/Artist/1 One.mp3"
+
+    with pytest.raises(Exception, match="unknown field in file name template: foo"):
+        naming.compile_template("{foo[0]}/{track}.{ext}")
+
+
+def test_plan_collisions(tmp_path, monkeypatch):
+    template = naming.compile_template("{artist}/{album}/{track}.{ext}")
+    with pytest.raises(Exception, match="tracks 1 and 2 map to the same file"):
+        template.plan(make_disc(["Same", "Same"]), "mp3")
+
+    # Names differing in case only collide on case-insensitive file systems.
+    disc = make_disc(["Same", "same"])
+    monkeypatch.setattr(naming, "_case_insensitive", lambda target: False)
+    template.plan(disc, "mp3", str(tmp_path))
+    monkeypatch.setattr(naming, "_case_insensitive", lambda target: True)
+    with pytest.raises(Exception, match="tracks 1 and 2 map to the same file"):
+        template.plan(disc, "mp3", str(tmp_path))
+
+
+def test_plan_existing(tmp_path):
+    template = naming.compile_template(TEMPLATE)
+    disc = make_disc(["One", "Two"])
+    target = str(tmp_path)
+    create(target, template.plan(disc, "mp3", target)[:1])
+
+    with pytest.raises(Exception, match="track 1: .* already exists"):
+        template.plan(disc, "mp3", target)
+
+
+def test_plan_retag(tmp_path):
+    # Retagging an album in the library plans over its own files.
+    template = naming.compile_template(TEMPLATE)
+    disc = make_disc(["One", "Two"])
+    target = str(tmp_path)
+    paths = create(target, template.plan(disc, "mp3", target))
+
+    assert template.plan(disc, "mp3", target, paths) == [
+        "Artist/Album/1 One.mp3",
+        "Artist/Album/2 Two.mp3",
+    ]
+
+    # Other files in the library are still protected.
+    disc.tracks[1].title = "Three"
+    create(target, ["Artist/Album/2 Three.mp3"])
+    with pytest.raises(Exception, match="track 2: .* already exists"):
+        template.plan(disc, "mp3", target, paths)
+
+
+def test_plan_extras(tmp_path):
+    template = naming.compile_template("{artist}/{album} - {trackno} {track}.{ext}")
+    target = str(tmp_path)
+    first = make_disc(["One", "Two"])
+    create(target, ["Artist/" + naming.cue_name(first)])
+
+    # Another album in the same directory gets a cue sheet of its own.
+    second = make_disc(["Three"])
+    second.album = "Other"
+    template.plan(second, "mp3", target, extras=[naming.cue_name(second)])
+
+    with pytest.raises(Exception, match="Album.cue already exists"):
+        template.plan(first, "mp3", target, extras=[naming.cue_name(first)])
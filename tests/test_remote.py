@@ -0,0 +1,76 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import asyncio
+import os
+
+import detect
+import pytest
+import remote
+
+TRACK = detect.TrackInfo(artist="", album="", title="", trackno=1)
+
+
+def encode(handler, workdir, data=b"RIFF....WAVEdata", timeout=None):
+    """
+    Encodes a track through a RemoteEncoder talking to a localhost server running
+    the given connection handler. Returns the encoder's output lines.
+    """
+    with open(os.path.join(workdir, "track1.wav"), "wb") as f:
+        f.write(data)
+
+    output = []
+
+    async def run():
+        server = await asyncio.start_server(handler, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            client = remote.RemoteEncoder(f"127.0.0.1:{port}", timeout)
+            await client.encode(
+                workdir, "track1.wav", "track1.wav.mp3", TRACK, output.append
+            )
+
+    asyncio.run(run())
+    return output
+
+
+def test_encode_roundtrip(tmp_path):
+    worker = remote.EncodeWorker("cp {input} {output}", jobs=1)
+    data = os.urandom(3 * remote.CHUNK_SIZE + 17)
+    encode(worker.handle, str(tmp_path), data)
+
+    with open(tmp_path / "track1.wav.mp3", "rb") as f:
+        assert f.read() == data
+
+
+def test_encoder_output_is_forwarded(tmp_path):
+    worker = remote.EncodeWorker("sh -c 'echo encoding; cp $0 $1' {input} {output}")
+    output = encode(worker.handle, str(tmp_path))
+    assert any(line.startswith("[127.0.0.1:") for line in output)
+    assert any(line.endswith("encoding") for line in output)
+
+
+def test_encoder_failure_is_reported(tmp_path):
+    worker = remote.EncodeWorker("false")
+    with pytest.raises(Exception, match="exited with 1"):
+        encode(worker.handle, str(tmp_path))
+
+
+def test_stalled_worker_times_out(tmp_path):
+    async def stall(reader, writer):
+        # Never answers; returns once the client gives up and disconnects.
+        await reader.read()
+        writer.close()
+
+    with pytest.raises(Exception, match="timed out"):
+        encode(stall, str(tmp_path), timeout=0.5)
+
+
+def test_serve_defaults_to_loopback(monkeypatch):
+    bound = []
+
+    async def serve(self, host, port):
+        bound.append((host, port))
+
+    monkeypatch.setattr(remote.EncodeWorker, "serve", serve)
+    remote.serve("7439", "lame {input} {output}")
+    remote.serve("0.0.0.0:7440", "lame {input} {output}")
+    assert bound == [("127.0.0.1", 7439), ("0.0.0.0", 7440)]
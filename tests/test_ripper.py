@@ -0,0 +1,73 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+
+import detect
+import naming
+import ripper
+
+# Both albums' tracks end up in the artist's directory.
+TEMPLATE = "{artist}/{album} - {trackno} {track}.{ext}"
+
+
+def make_disc(album, discid, titles):
+    tracks = [
+        detect.TrackInfo(artist="Artist", album=album, title=t, trackno=i + 1)
+        for i, t in enumerate(titles)
+    ]
+    return detect.CDInfo(
+        artist="Artist",
+        album=album,
+        tracks=tracks,
+        discno=1,
+        year=2000,
+        set_size=1,
+        multi_artist=False,
+        cover_art=b"cover",
+        discid=discid,
+    )
+
+
+def commit(disc, workdir, target):
+    """
+    Commits a disc's encoded tracks like rip() does, with a sidecar cover, a cue
+    sheet and the rip's stats.
+    """
+    encoded = []
+    for t in disc.tracks:
+        path = os.path.join(workdir, f"{disc.discid}-track{t.trackno}.mp3")
+        open(path, "wb").close()
+        encoded.append(path)
+
+    staging = os.path.join(workdir, f"staging-{disc.discid}")
+    os.mkdir(staging)
+    template = naming.compile_template(TEMPLATE)
+    extras = [naming.stats_name(disc), naming.cue_name(disc)]
+    template.plan(disc, "mp3", target, extras=extras)
+
+    album_dir = ripper.rename_files(
+        disc, encoded, staging, TEMPLATE, sidecar=disc.cover_art, cue=True
+    )
+    with open(os.path.join(album_dir, naming.stats_name(disc)), "w") as f:
+        f.write("{}")
+    ripper.commit_files(staging, target)
+
+
+def test_commit_shared_directory(tmp_path):
+    workdir = tmp_path / "work"
+    target = tmp_path / "library"
+    workdir.mkdir()
+    target.mkdir()
+
+    commit(make_disc("First", "disc-a", ["One", "Two"]), str(workdir), str(target))
+    commit(make_disc("Second", "disc-b", ["Three"]), str(workdir), str(target))
+
+    assert sorted(os.listdir(target / "Artist")) == [
+        "First - 1 One.mp3",
+        "First - 2 Two.mp3",
+        "First.cue",
+        "Second - 1 Three.mp3",
+        "Second.cue",
+        "folder.jpg",
+        "rip-stats-disc-a.json",
+        "rip-stats-disc-b.json",
+    ]
@@ -0,0 +1,23 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import os
+
+import scheduling
+
+
+def test_command_wrappers(monkeypatch):
+    monkeypatch.setattr(scheduling.shutil, "which", lambda name: f"/usr/bin/{name}")
+    nice = os.getpriority(os.PRIO_PROCESS, 0)
+
+    policy = scheduling.StagePolicy.parse(f"nice={nice + 5},ionice=2:7,cpus=0+2-3")
+    wrappers = ["taskset", "-c", "0,2,3", "nice", "-n", "5"]
+    wrappers += ["ionice", "-c", "2", "-n", "7"]
+    assert policy.command(["lame", "in.wav"]) == wrappers + ["lame", "in.wav"]
+
+
+def test_command_unchanged(monkeypatch):
+    cmd = ["lame", "in.wav"]
+    assert scheduling.StagePolicy.parse("").command(cmd) is cmd
+
+    # Wrappers that aren't installed are skipped.
+    monkeypatch.setattr(scheduling.shutil, "which", lambda name: None)
+    assert scheduling.StagePolicy.parse("nice=19,cpus=0").command(cmd) is cmd
@@ -0,0 +1,66 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import cdreader
+import speed
+import telemetry
+
+DRIVE = "test drive"
+TRACK_SECTORS = 300
+TRACK_LBA = cdreader.LBA_OFFSET
+
+
+def rip(controller, bad=None):
+    """
+    Reads a track at the controller's current speed from an image with the given
+    bad sectors, and passes its stats to the controller. Returns True if the
+    controller slowed down.
+    """
+    source = cdreader.ImageSource(bad=bad)
+    source.set_speed(controller.current)
+    reader = cdreader.NativeReader(source)
+    stats = reader.read(TRACK_LBA, TRACK_SECTORS, lambda data: None)
+    assert source.speed == controller.current
+    return controller.update(telemetry.from_read_stats(1, stats))
+
+
+def test_step_down(tmp_path):
+    store = speed.SpeedStore(str(tmp_path / "speeds.json"))
+    controller = speed.SpeedController(store, DRIVE)
+    assert controller.current is None
+
+    assert not rip(controller)
+    assert controller.current is None
+
+    # The batch read fails, then 20 retries of the sector: above the spike rate.
+    assert rip(controller, {100: 21})
+    assert controller.current == speed.SPEEDS[1]
+
+    assert not rip(controller)
+    assert controller.current == speed.SPEEDS[1]
+
+    entry = store.profiles[DRIVE]["max"]
+    assert entry["sectors"] == 2 * TRACK_SECTORS
+    assert entry["rereads"] == 20
+    assert store.profiles[DRIVE]["40"]["sectors"] == TRACK_SECTORS
+
+
+def test_recovery(tmp_path, monkeypatch):
+    monkeypatch.setattr(speed, "MIN_SECTORS", TRACK_SECTORS)
+    store = speed.SpeedStore(str(tmp_path / "speeds.json"))
+
+    # A damaged disc, read quickly at the maximum speed but with two sectors lost.
+    controller = speed.SpeedController(store, DRIVE)
+    damaged = telemetry.TrackStats(1, sectors=TRACK_SECTORS, elapsed=1e-6)
+    damaged.reads = TRACK_SECTORS
+    damaged.skips = [10, 11]
+    assert controller.update(damaged)
+
+    # The next discs avoid the maximum speed while the problems decay.
+    for _ in range(2):
+        controller = speed.SpeedController(store, DRIVE)
+        assert controller.current == speed.SPEEDS[1]
+        assert not rip(controller)
+
+    controller = speed.SpeedController(store, DRIVE)
+    assert controller.current is None
+    assert not rip(controller)
+    assert controller.current is None
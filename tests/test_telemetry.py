@@ -0,0 +1,99 @@
+# SPDX-License-Identifier: BSD-2-Clause
+import telemetry
+
+# "cdparanoia -e" output for the first 130 sectors of a clean track: reads in
+# 26-sector blocks, verified with overlap, and written out as they're verified.
+CLEAN = """\
+cdparanoia III release 10.2 (September 11, 2008)
+
+Ripping from sector       0 (track  1 [0:00.00])
+\t  to sector     129 (track  1 [0:01.54])
+
+outputting to track01.cdda.wav
+
+##: 0 [read] @ 30576
+##: 0 [read] @ 61152
+##: 1 [verify] @ 29988
+##: 9 [overlap] @ 31752
+##: -2 [wrote] @ 1175
+##: -2 [wrote] @ 2351
+##: 0 [read] @ 91728
+##: 1 [verify] @ 60564
+##: 9 [overlap] @ 31752
+##: -2 [wrote] @ 35279
+##: 0 [read] @ 122304
+##: 1 [verify] @ 91140
+##: 9 [overlap] @ 31752
+##: -2 [wrote] @ 70559
+##: 0 [read] @ 152880
+##: 1 [verify] @ 121716
+##: -2 [wrote] @ 152879
+##: -1 [finished] @ 152879
+
+Done.
+"""
+
+# The same range on a scratched disc: paranoia seeks back to re-read the start,
+# repairs what it can and skips a sector it can't recover.
+SCRATCHED = """\
+##: 0 [read] @ 30576
+##: 0 [read] @ 61152
+##: 0 [read] @ 91728
+##: 0 [read] @ 122304
+##: 0 [read] @ 152880
+##: 1 [verify] @ 29988
+##: 2 [jitter] @ 29400
+##: 0 [read] @ 30576
+##: 3 [correction] @ 31164
+##: 12 [transport error] @ 35280
+##: 7 [drift] @ 36456
+##: 5 [scratch repair] @ 98784
+##: 6 [skip] @ 99960
+##: 8 [backoff] @ 98784
+##: 1 [verify] @ 121716
+##: -2 [wrote] @ 152879
+##: -1 [finished] @ 152879
+"""
+
+
+def parse(output):
+    log = telemetry.ParanoiaLog()
+    rest = [line for line in output.splitlines() if not log.feed(line)]
+    return log, rest
+
+
+def test_progress_lines():
+    log, rest = parse(CLEAN)
+    assert all(not line.startswith("##:") for line in rest)
+    assert "outputting to track01.cdda.wav" in rest
+
+
+def test_clean_read():
+    log, _ = parse(CLEAN)
+    stats = log.stats(1, 0, 130, elapsed=1.0)
+    assert stats.reads == 4
+    assert stats.rereads == 0
+    assert stats.corrections == 0
+    assert stats.read_errors == 0
+    assert stats.skips == []
+    assert stats.heat == [0, 0]
+
+
+def test_scratched_read():
+    log, _ = parse(SCRATCHED)
+    stats = log.stats(1, 0, 130, elapsed=1.0)
+    assert stats.reads == 5
+    assert stats.rereads == 1
+    assert stats.corrections == 4
+    assert stats.read_errors == 1
+    assert stats.skips == [85]
+    assert stats.heat == [5, 2]
+
+
+def test_stats_range():
+    log, _ = parse(SCRATCHED)
+    stats = log.stats(2, 75, 55, elapsed=1.0)
+    assert stats.reads == 2
+    assert stats.corrections == 1
+    assert stats.skips == [85]
+    assert stats.heat == [2]